@@ -0,0 +1,124 @@
+'''
+The admin, kept responsive on large trees.
+
+Every changelist counts its table twice (once filtered for the paginator, once unfiltered for the "N total" link)
+and a list_filter on a plain field lists its distinct values with a scan of the table on every page. Here the
+unfiltered total isn't counted at all, the paginator estimates the count of large unfiltered tables rather than
+counting them, and filtering on klass offers the klasses of the Middles, looked up once a minute. The objects each
+row reports to are joined in with list_select_related, and the annotations of each Top and Middle are computed in
+the changelist's one query.
+'''
+from django.contrib import admin
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db.models import Max, QuerySet
+from django.utils.functional import cached_property
+
+from DjangoAnnotation.expressions import SubqueryCount, SumOfMax
+from DjangoAnnotation.models import Top, Middle, Lower, Person
+from DjangoAnnotation.strategies import from_rollup
+
+
+class EstimatedCountPaginator(Paginator):
+    '''
+    A Paginator that takes the count of an unfiltered QuerySet from its largest primary key rather than counting
+    its rows, which on SQLite means reading every row of the table's smallest index.
+
+    Ids are never reused (Django's SQLite tables are AUTOINCREMENT), so the estimate is exact until rows are
+    deleted, and then it's high: the last pages may come up short or empty. Filtered QuerySets, and tables with
+    fewer than EXACT_BELOW rows, are counted as usual.
+    '''
+    EXACT_BELOW = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if isinstance(queryset, QuerySet) and not queryset.query.where:
+            estimate = queryset.model._default_manager.using(queryset.db).aggregate(estimate=Max('pk'))['estimate'] or 0
+            if estimate >= self.EXACT_BELOW:
+                return estimate
+        return super().count
+
+
+class KlassFilter(admin.SimpleListFilter):
+    '''
+    Filters on klass, offering the klasses of the Middles (which Lowers copy), looked up at most once a minute.
+    '''
+    title = 'klass'
+    parameter_name = 'klass'
+
+    def lookups(self, request, model_admin):
+        klasses = cache.get_or_set('admin_klasses', lambda: list(Middle.objects.order_by('klass').values_list('klass', flat=True).distinct()), 60)
+        return [(klass, klass) for klass in klasses]
+
+    def queryset(self, request, queryset):
+        return queryset if self.value() is None else queryset.filter(klass=self.value())
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    # Don't count the whole table for the "N total" link beside the filtered count
+    show_full_result_count = False
+
+
+@admin.register(Top)
+class TopAdmin(LargeTableAdmin):
+    list_display = ('name', 'middle_count', 'lower_count', 'high_rank_sums')
+    search_fields = ('name',)
+
+    def get_queryset(self, request):
+        # The annotations are read from TopRollup, joined in to the changelist's query
+        queryset = from_rollup()
+        ordering = self.get_ordering(request)
+        return queryset.order_by(*ordering) if ordering else queryset
+
+    @admin.display(ordering='middle_count')
+    def middle_count(self, top):
+        return top.middle_count
+
+    @admin.display(ordering='lower_count')
+    def lower_count(self, top):
+        return top.lower_count
+
+    @admin.display(ordering='high_rank_sums')
+    def high_rank_sums(self, top):
+        return top.high_rank_sums
+
+
+@admin.register(Middle)
+class MiddleAdmin(LargeTableAdmin):
+    list_display = ('name', 'klass', 'reports_to', 'lower_count', 'high_rank_sums')
+    list_filter = (KlassFilter,)
+    list_select_related = ('reports_to',)
+    raw_id_fields = ('reports_to',)
+    search_fields = ('name',)
+
+    def get_queryset(self, request):
+        # Each Middle's own annotations, in correlated subqueries on the covering indexes of its Lowers
+        return super().get_queryset(request).annotate(
+            lower_count=SubqueryCount('lowers'),
+            high_rank_sums=SumOfMax('lowers__rank', group_by='lowers__person'),
+        )
+
+    @admin.display(ordering='lower_count')
+    def lower_count(self, middle):
+        return middle.lower_count
+
+    @admin.display(ordering='high_rank_sums')
+    def high_rank_sums(self, middle):
+        return middle.high_rank_sums
+
+
+@admin.register(Lower)
+class LowerAdmin(LargeTableAdmin):
+    list_display = ('name', 'rank', 'reports_to', 'top', 'klass')
+    list_filter = (KlassFilter,)
+    list_select_related = ('reports_to', 'top')
+    raw_id_fields = ('reports_to',)
+    search_fields = ('name',)
+
+
+@admin.register(Person)
+class PersonAdmin(LargeTableAdmin):
+    list_display = ('name', 'last_rank')
+    search_fields = ('name',)
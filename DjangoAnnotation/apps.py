@@ -0,0 +1,15 @@
+from django.apps import AppConfig
+
+
+class DjangoAnnotationConfig(AppConfig):
+    name = 'DjangoAnnotation'
+
+    def ready(self):
+        # Connects the signal handlers that keep the copies of each Lower's Top and klass up to date
+        from DjangoAnnotation import denormalise  # @UnusedImport
+        # Connects the signal handlers that keep TopRollup up to date
+        from DjangoAnnotation import rollup  # @UnusedImport
+        # Connects the handler that applies settings.SQLITE_PROFILE to new connections
+        from DjangoAnnotation import sqlite  # @UnusedImport
+        # Connects the handlers that bump the table versions the annotation cache is keyed on
+        from DjangoAnnotation import cache  # @UnusedImport
@@ -0,0 +1,44 @@
+'''
+Async variants of the annotation queries, for use in async views under ASGI.
+
+They use Django's async QuerySet API (aiterator, aaggregate), so awaiting them yields the event loop to other
+requests while the query runs. Django's database backends are still synchronous underneath: the queries run in
+a worker thread (one per event loop, as sync_to_async runs thread sensitive code in one thread), so concurrent
+requests overlap their waiting and their Python, not their SQL.
+'''
+from django.db.models import Count, Sum
+
+from DjangoAnnotation.models import Middle
+from DjangoAnnotation.oracle import Annotations
+from DjangoAnnotation.strategies import highest_ranks, subqueries
+
+
+async def annotated_tops(klass=None, after=None, limit=None):
+    '''
+    The Tops in id order, annotated with middle_count, lower_count and high_rank_sums (see strategies.subqueries).
+
+    :param klass: The klass of Middle to restrict the annotations to (None for any klass)
+    :param after: Only Tops with an id greater than this
+    :param limit: At most this many Tops
+    '''
+    tops = subqueries(klass).order_by('id')
+    if after is not None:
+        tops = tops.filter(id__gt=after)
+    if limit is not None:
+        tops = tops[:limit]
+    return [top async for top in tops.aiterator()]
+
+
+async def top_annotations(top, klass=None):
+    '''
+    The Annotations of one Top (or Top id), with an aggregate query for the counts and one for the sum of maxima.
+
+    :param top:   A Top or Top id
+    :param klass: The klass of Middle to restrict the annotations to (None for any klass)
+    '''
+    middles = Middle.objects.filter(reports_to=top)
+    if klass is not None:
+        middles = middles.filter(klass=klass)
+    counts = await middles.aaggregate(middle_count=Count('id', distinct=True), lower_count=Count('lowers'))
+    sums = await highest_ranks(top, klass).aaggregate(total=Sum('highest_rank'))
+    return Annotations(counts['middle_count'], counts['lower_count'], sums['total'])
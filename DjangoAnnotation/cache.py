@@ -0,0 +1,111 @@
+'''
+Caches the annotated Tops the strategies return, in Django's cache (local memory unless settings say otherwise).
+
+The annotations are a pure function of the contents of the tables and the klass asked for, so rather than
+deleting what's cached when data changes, every key includes the version of each table the annotations are read
+from. A TableVersion row counts the changes to each table, so a write moves the keys on and what was cached before
+it is simply never asked for again (and ages out of the cache). The versions live in the database, not the cache,
+so writes made by other processes invalidate this one's cache too, at the cost of one query per cached read.
+
+Saving or deleting a Top, Middle or Lower marks its table as changed, and the versions are bumped in one batch
+when the transaction commits (immediately in autocommit mode). Bulk operations (bulk_create, QuerySet.update and
+the like) send no signals, so code that uses them must bump() the tables it changed. DjangoAnnotation.rollup
+bumps TopRollup when it writes rollups.
+'''
+import threading
+
+from django.core.cache import cache
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.db import transaction
+from django.db.models import F, Max
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from DjangoAnnotation.models import Top, Middle, Lower, TopRollup, TableVersion
+from DjangoAnnotation.strategies import select
+
+# The tables the annotations are read from, whose versions key the cache
+VERSIONED = (Top, Middle, Lower, TopRollup)
+
+# Per thread: the tables changed in the current transaction
+state = threading.local()
+
+
+def versions():
+    '''
+    The versions of the VERSIONED tables, as a tuple.
+    '''
+    found = dict(TableVersion.objects.filter(table__in=[m._meta.db_table for m in VERSIONED]).values_list('table', 'version'))
+    return tuple(found.get(m._meta.db_table, 0) for m in VERSIONED)
+
+
+def last_modified():
+    '''
+    When the VERSIONED tables were last changed (None if they never have been, as far as we know).
+    '''
+    return TableVersion.objects.filter(table__in=[m._meta.db_table for m in VERSIONED]).aggregate(last=Max('modified'))['last']
+
+
+def bump(*models):
+    '''
+    Bumps the versions of the tables of some models (by default all the VERSIONED tables), invalidating what's
+    been cached from them.
+    '''
+    for model in (models or VERSIONED):
+        table = model._meta.db_table
+        if not TableVersion.objects.filter(table=table).update(version=F('version') + 1, modified=timezone.now()):
+            TableVersion.objects.get_or_create(table=table, defaults={'version': 1})
+
+
+def key(strategy, klass=None, top=None):
+    '''
+    The cache key of the annotations a strategy returns, for the tables as they stand.
+    '''
+    return f"annotations:{strategy}:{klass}:{top}:{'.'.join(str(v) for v in versions())}"
+
+
+def annotated_tops(strategy, klass=None, top=None, timeout=DEFAULT_TIMEOUT):
+    '''
+    The annotated Tops a strategy returns (see DjangoAnnotation.strategies.select), as a list, from the cache if
+    nothing has changed since they were cached.
+
+    :param strategy: A Strategy or the name of one
+    :param klass:    The klass of Middle to restrict the annotations to (None for any klass)
+    :param top:      Optionally a Top or Top id to annotate alone
+    :param timeout:  How long to cache them for, in seconds (by default the cache's TIMEOUT)
+    '''
+    name = getattr(strategy, 'name', strategy)
+    cache_key = key(name, klass, getattr(top, 'pk', top))
+    tops = cache.get(cache_key)
+    if tops is None:
+        tops = list(select(strategy, klass, top))
+        cache.set(cache_key, tops, timeout)
+    return tops
+
+
+def flush():
+    tables = getattr(state, 'changed', None)
+    if tables:
+        state.changed = set()
+        bump(*tables)
+
+
+def mark(model, using=None):
+    if not hasattr(state, 'changed'):
+        state.changed = set()
+    state.changed.add(model)
+    # The first flush to run bumps every table changed in the transaction, and leaves the rest registered by later
+    # changes with nothing to do. They run when the database written to (which may be a shard, see
+    # DjangoAnnotation.sharding) commits.
+    transaction.on_commit(flush, using=using)
+
+
+@receiver(post_save, sender=Top)
+@receiver(post_save, sender=Middle)
+@receiver(post_save, sender=Lower)
+@receiver(post_delete, sender=Top)
+@receiver(post_delete, sender=Middle)
+@receiver(post_delete, sender=Lower)
+def changed(sender, using, **kwargs):
+    mark(sender, using)
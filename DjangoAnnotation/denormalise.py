@@ -0,0 +1,84 @@
+'''
+Keeps Lower.top and Lower.klass, copies of the Top and klass of the Middle a Lower reports to, in step with it.
+
+Reaching a Lower's Top through its Middle (reports_to__reports_to) joins Middle into every per Top aggregate.
+With the copies, and the index on Lower (top, klass, name, rank), the Lowers of a Top (of a klass) are found and
+grouped from Lower alone.
+
+Saving a Lower copies them from its Middle, and saving a Middle (which may have moved to another Top or changed
+klass) updates its Lowers. Saving a Lower also points it at the Person of its name (Lower.person), made if need be,
+which Lowers ranked in bulk are given by DjangoAnnotation.ranks. Bulk operations send no signals: bulk_create of
+Lowers needs them set (fill() does so for Lowers whose Middles exist), and after a QuerySet.update of Middles or
+raw SQL, backfill() puts them right.
+'''
+from django.db import DEFAULT_DB_ALIAS, router
+from django.db.models import F, OuterRef, Subquery
+from django.db.models.signals import pre_save, post_save
+from django.dispatch import receiver
+
+from DjangoAnnotation import cache
+from DjangoAnnotation.models import Middle, Lower, Person
+
+
+def fill(lowers, using=None):
+    '''
+    Sets the top and klass of unsaved Lowers from their Middles, in a query per 500 Middles, returning the Lowers.
+
+    :param lowers: An iterable of unsaved Lowers
+    :param using:  The database alias, by default the one the router picks for reading Middles
+    '''
+    lowers = list(lowers)
+    using = using or router.db_for_read(Middle)
+    middles = list({lower.reports_to_id for lower in lowers})
+    parents = {}
+    for i in range(0, len(middles), 500):
+        parents.update((m, (t, k)) for m, t, k in Middle.objects.using(using).filter(id__in=middles[i:i + 500]).values_list('id', 'reports_to_id', 'klass'))
+    for lower in lowers:
+        lower.top_id, lower.klass = parents[lower.reports_to_id]
+    return lowers
+
+
+def stale(using=None):
+    '''
+    The Lowers whose top or klass differs from their Middle's.
+    '''
+    return Lower.objects.using(using).exclude(top=F('reports_to__reports_to'), klass=F('reports_to__klass'))
+
+
+def backfill(using=None):
+    '''
+    Copies the Top and klass of every stale Lower's Middle to it, returning the number of Lowers updated.
+    '''
+    middle = Middle.objects.using(using).filter(pk=OuterRef('reports_to'))
+    updated = stale(using).update(top=Subquery(middle.values('reports_to')[:1]), klass=Subquery(middle.values('klass')[:1]))
+    if updated:
+        cache.bump(Lower)
+    return updated
+
+
+@receiver(pre_save, sender=Lower)
+def copy_from_middle(sender, instance, **kwargs):
+    # Fetches the Middle unless it's cached on the Lower
+    middle = instance.reports_to
+    instance.top_id, instance.klass = middle.reports_to_id, middle.klass
+
+
+@receiver(pre_save, sender=Lower)
+def intern_name(sender, instance, using, **kwargs):
+    # The name may have changed, so the Person is looked up whatever it was. The Persons are kept in the default
+    # database, and a shard holds copies of those its Lowers refer to (see DjangoAnnotation.sharding).
+    person, created = Person.objects.using(DEFAULT_DB_ALIAS).get_or_create(name=instance.name, defaults={'last_rank': instance.rank})
+    if not created:
+        # The counter is moved past the rank, so that no Lower ranked later is given it again
+        Person.objects.using(DEFAULT_DB_ALIAS).filter(pk=person.pk, last_rank__lt=instance.rank).update(last_rank=instance.rank)
+    if using != DEFAULT_DB_ALIAS:
+        Person.objects.using(using).get_or_create(id=person.id, defaults={'name': person.name})
+    instance.person_id = person.id
+
+
+@receiver(post_save, sender=Middle)
+def copy_to_lowers(sender, instance, created, using, **kwargs):
+    if not created:
+        lowers = Lower.objects.using(using).filter(reports_to=instance).exclude(top=instance.reports_to_id, klass=instance.klass)
+        if lowers.update(top=instance.reports_to_id, klass=instance.klass):
+            cache.mark(Lower, using)
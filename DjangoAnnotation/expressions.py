@@ -0,0 +1,98 @@
+'''
+Query expressions for annotations Django's aggregates can't express directly.
+
+Aggregating across two levels of multi-valued relations in one GROUP BY either fans the join out (counts need
+distinct, sums over-count) or, as with a sum of maxima, is impossible: SQL can't nest aggregates in one query.
+These expressions instead compute the aggregate for each row in a correlated subquery over the row's own model,
+so the aggregation happens in its own GROUP BY and the annotated QuerySet can still be filtered, ordered and
+chained as usual.
+'''
+from django.db.models import Count, Expression, IntegerField, Max, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+class CorrelatedAggregate(Expression):
+    '''
+    The base of expressions that aggregate over related rows in a subquery correlated on the outer row's pk.
+
+    Subclasses implement subquery(queryset), given a QuerySet of the outer model already filtered to the outer
+    row and by the filter (as one filter() call so they share joins), to return the subquery's values QuerySet.
+    '''
+    template = '(%(subquery)s)'
+
+    def __init__(self, expression, filter=None, output_field=None):  # @ReservedAssignment
+        super().__init__(output_field=output_field or IntegerField())
+        self.expression = expression
+        self.filter = filter
+
+    def subquery(self, queryset):
+        raise NotImplementedError
+
+    def wrap(self, subquery):
+        return subquery
+
+    def resolve_expression(self, query=None, allow_joins=True, reuse=None, summarize=False, for_save=False):
+        manager = query.model._default_manager
+        if self.filter is None:
+            queryset = manager.filter(pk=OuterRef('pk'))
+        else:
+            queryset = manager.filter(self.filter, pk=OuterRef('pk'))
+        subquery = Subquery(self.subquery(queryset), output_field=self.output_field)
+        subquery.template = self.template
+        return self.wrap(subquery).resolve_expression(query, allow_joins, reuse, summarize, for_save)
+
+
+class SumOfMax(CorrelatedAggregate):
+    '''
+    The sum, over groups of related rows, of the maximum of a field in each group. For example the sum of the
+    highest rank of each Lower name under a Top:
+
+        Top.objects.annotate(high_rank_sums=SumOfMax('middles__lowers__rank', group_by='middles__lowers__name'))
+
+    and restricted to Middles of klass 2:
+
+        SumOfMax('middles__lowers__rank', group_by='middles__lowers__name', filter=Q(middles__klass=2))
+
+    Like Sum, it is None for rows with nothing to sum.
+
+    :param expression: The field (path) to take the maximum of
+    :param group_by:   The field (path) to group related rows by, or a list of them
+    :param filter:     Optionally a Q object restricting the related rows, expressed from the outer model
+    '''
+    template = '(SELECT SUM("max_value") FROM (%(subquery)s) "sum_of_max")'
+
+    def __init__(self, expression, group_by, filter=None, output_field=None):  # @ReservedAssignment
+        super().__init__(expression, filter, output_field)
+        self.group_by = [group_by] if isinstance(group_by, str) else list(group_by)
+
+    def subquery(self, queryset):
+        return queryset.values(*self.group_by).annotate(max_value=Max(self.expression)).values('max_value')
+
+
+class SubqueryCount(CorrelatedAggregate):
+    '''
+    A count of related rows, computed in a subquery of its own. Annotating several counts with Count joins every
+    relation counted into one query, multiplying the rows grouped (Tops x Middles x Lowers) and needing distinct
+    to undo the fan out. Instead:
+
+        Top.objects.annotate(middle_count=SubqueryCount('middles'), lower_count=SubqueryCount('middles__lowers'))
+
+    and restricted to Middles of klass 2:
+
+        SubqueryCount('middles__lowers', filter=Q(middles__klass=2))
+
+    Each count joins only the relations on its own path (and its filter's), in a subquery per row. It counts
+    distinct rows, as a filter reaching past the path counted (say on middles__lowers when counting middles) joins
+    rows it would otherwise count again, which costs little at the size of one row's relations. Like Count it is 0
+    for rows with nothing to count.
+
+    :param expression: The relation (path) to count
+    :param filter:     Optionally a Q object restricting the related rows, expressed from the outer model
+    '''
+
+    def subquery(self, queryset):
+        return queryset.values('pk').annotate(count=Count(self.expression, distinct=True)).values('count')
+
+    def wrap(self, subquery):
+        # When the filter excludes every related row the subquery returns no rows at all
+        return Coalesce(subquery, Value(0), output_field=self.output_field)
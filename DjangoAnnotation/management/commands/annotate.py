@@ -1,124 +1,66 @@
-from django.core.management.base import BaseCommand
+import time
+
 from django.db.models.aggregates import Max
 
+from DjangoAnnotation.expressions import SumOfMax
 from DjangoAnnotation.models import Top, Middle, Lower
+from DjangoAnnotation.oracle import Oracle
+from DjangoAnnotation.parallel import EXECUTORS, per_top
+from DjangoAnnotation.profiling import ProfiledCommand
+from DjangoAnnotation.sql import format_plan, get_SQL, print_SQL
+from DjangoAnnotation.strategies import STRATEGIES, explain, sum_of_max_raw
+from DjangoAnnotation.vectorised import VectorOracle
 
 from django.db.models import Case, Count, IntegerField, Sum, When, OuterRef, Subquery, Q, F, Window
 from django.db.models.functions import RowNumber
-from django.db import connection
-
-import sqlparse
-from datetime import datetime, timedelta
-
-def get_SQL(queryset, explain=False, pretty=True):
-    '''
-    A workaround for a bug in Django which is reported here (several times):
-        https://code.djangoproject.com/ticket/30132
-        https://code.djangoproject.com/ticket/25705
-        https://code.djangoproject.com/ticket/25092
-        https://code.djangoproject.com/ticket/24991
-        https://code.djangoproject.com/ticket/17741
-
-    that should be documented here:
-        https://docs.djangoproject.com/en/2.1/faq/models/#how-can-i-see-the-raw-sql-queries-django-is-running
-    but isn't.
-
-    The work around was published by Zach Borboa here:
-        https://code.djangoproject.com/ticket/17741#comment:4
-
-    :param queryset: A Django QuerySet
-    :param explain:  If True uses the server's EXPLAIN function. Not good for invalid SQL alas.
-    :param pretty:   Format the SQL nicely
-    '''
-    if explain:
-        sql, params = queryset.query.sql_with_params()
-        cursor = connection.cursor()
-        cursor.execute('EXPLAIN ' + sql, params)
-        SQL = cursor.db.ops.last_executed_query(cursor, sql, params).replace("EXPLAIN ", "", 1)
-    else:
-        # We don't want to execute a query in this case but find the SQL reliablyf rom Django
-
-        # We can get SQL and params from the query compiler
-        sql, params = queryset.query.get_compiler(using=queryset.db).as_sql()
-
-        # params is a dict of parameters.
-        # DateTimes and TimeDeltas are alas converted to strings without the requiste
-        # wrapping in single quotes. So we replace them by strign reps wrapped in single
-        # quotes
-        params = list(params)
-        for i, p in enumerate(params):
-            if isinstance(p, datetime):
-                params[i] = "'" + str(p) + "'"
-            elif isinstance(p, timedelta):
-                params[i] = "INTERVAL '" + str(p) + "'"
-        params = tuple(params)
-
-        # And this is used when excuted as described here:
-        #  https://docs.djangoproject.com/en/2.2/topics/db/sql/#passing-parameters-into-raw
-        #
-        # The key note being:
-        #     params is a list or dictionary of parameters.
-        #     You’ll use %s placeholders in the query string for a list,
-        #     or %(key)s placeholders for a dictionary (where key is replaced
-        #     by a dictionary key, of course)
-        #
-        # Which is precisely how Python2 standard % formating works.
-        SQL = sql % params
-
-    if pretty:
-        return sqlparse.format(SQL, reindent=True, keyword_case='upper')
-    else:
-        return SQL
-
-
-def print_SQL(queryset, explain=False, pretty=True):
-    '''
-    A trivial wrapper around get_SQL that simply prints the result. Useful primarily in a debugger say, to
-    produce a SQL string that can be copied and pasted into a Query Tool. That is, it doesn't have quotes
-    around it for example.
-
-    :param queryset: A Django QuerySet
-    :param explain:  If True uses the server's EXPLAIN function. Not good for invalid SQL alas.
-    :param pretty:   Format the SQL nicely
-    '''
-    print(get_SQL(queryset, explain, pretty))
-
-
-class Command(BaseCommand):
+
+# The ways of computing the expected annotations (numpy needs NumPy installed)
+ORACLES = {'python': Oracle, 'numpy': VectorOracle}
+
+
+class Command(ProfiledCommand):
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Check each Top individually on a pool of this many workers (default: 1, sequentially in the one connection).')
+        parser.add_argument('--executor', choices=sorted(EXECUTORS), default='thread', help='The kind of worker to use (default: thread).')
+        parser.add_argument('--denormalised', action='store_true',
+                            help="When checking each Top, find its Lowers by their copy of their Middle's Top (Lower.top) rather than through Middle.")
+        parser.add_argument('--oracle', choices=sorted(ORACLES), default='python',
+                            help='Compute the expected annotations by streaming the tree through Python or with NumPy arrays (default: python).')
+        parser.add_argument('--explain', action='store_true',
+                            help='Show the SQL and query plan of each strategy (with full scans and temporary B-trees flagged) rather than testing them.')
+
     def handle(self, *args, **options):
+        if options['explain']:
+            self.explain_strategies()
+            return
+
+        # Everything we expect, for all klasses, from one streamed query (or a few column fetches with numpy)
+        start = time.perf_counter()
+        oracle = ORACLES[options['oracle']]()
+        print(f"Expected annotations of {len(oracle.names)} Tops from the {options['oracle']} oracle in {time.perf_counter() - start:.3f}s")
+
         print("Narrow scope:")
 
-        expected = {}
         print("\tExpected Annotations (no klass):")
-        for T in Top.objects.all():
-            annos = [0, 0]
-            for M in T.middles.all():
-                annos[0] += 1
-                for L in M.lowers.all():
-                    annos[1] += 1
-            print(f"\t\t{T.name}: {annos[0]}, {annos[1]}")
-            expected[T.name] = tuple(annos)
+        for top, name in oracle.names.items():
+            annos = oracle.get(top)
+            print(f"\t\t{name}: {annos.middle_count}, {annos.lower_count}")
 
         annotated = Top.objects.all().annotate(middle_count=Count('middles', distinct=True), lower_count=Count('middles__lowers', distinct=True))
 
         print("\tCreated Annotations (no klass):")
         for T in annotated:
             annos = (T.middle_count, T.lower_count)
-            status = "PASS" if annos == expected[T.name] else "FAIL"
+            status = "PASS" if annos == oracle.get(T)[:2] else "FAIL"
             print(f"\t{T.name}: {T.middle_count}, {T.lower_count}    {status}")
 
         klass = 1
         mfilter = Q(middles__klass=klass)
-        expected = {}
         print(f"\tExpected Annotations (klass {klass}):")
-        for T in Top.objects.all():
-            annos = [0, 0]
-            for M in T.middles.filter(klass=1):
-                annos[0] += 1
-                for L in M.lowers.all():
-                    annos[1] += 1
-            print(f"\t\t{T.name}: {annos[0]}, {annos[1]}")
-            expected[T.name] = tuple(annos)
+        for top, name in oracle.names.items():
+            annos = oracle.get(top, klass)
+            print(f"\t\t{name}: {annos.middle_count}, {annos.lower_count}")
 
         annotated = Top.objects.annotate(
             middle_count=Count('middles', distinct=True, filter=mfilter),
@@ -129,7 +71,7 @@ class Command(BaseCommand):
         try:
             for T in annotated:
                 annos = (T.middle_count, T.lower_count)
-                status = "PASS" if annos == expected[T.name] else "FAIL"
+                status = "PASS" if annos == oracle.get(T, klass)[:2] else "FAIL"
                 print(f"\t\t{T.name}: {T.middle_count}, {T.lower_count}    {status}")
         except Exception as E:
             print(E.args)
@@ -139,26 +81,26 @@ class Command(BaseCommand):
 
         print("Broad scope:")
 
-        expected = {}
-        def test_top(top, klass=None):
-            l_filter = Q(reports_to__reports_to=top)
-            if not klass is None:
-                l_filter &= Q(reports_to__klass=klass)
-            highest_ranks = Lower.objects.filter(l_filter).values('reports_to__reports_to', 'name').annotate(highest_rank=Max('rank')).values('highest_rank')
-            sum_highest_ranks = highest_ranks.aggregate(total=Sum('highest_rank'))
-            if not top.name in expected: expected[top.name] = {}
-            expected[top.name][klass] = sum_highest_ranks['total']
-            print(f"\t\tGot sum of {sum_highest_ranks['total']}, for {top.name} from:")
-            for r in highest_ranks:
-                print(f"\t\t\t{r}")
+        def test_tops(klass=None):
+            # A query per Top, as a cross check on the oracle, optionally spread over a pool of workers
+            start = time.perf_counter()
+            found = per_top(klass, workers=options['workers'], executor=options['executor'], denormalised=options['denormalised'])
+            elapsed = time.perf_counter() - start
+            for top, name in oracle.names.items():
+                total, top_highest_ranks = found[top]
+                status = "PASS" if total == oracle.get(top, klass).high_rank_sums else "FAIL"
+                print(f"\t\tGot sum of {total}, for {name} from:    {status}")
+                for r in top_highest_ranks:
+                    print(f"\t\t\t{r}")
+            workers, executor = options['workers'], options['executor']
+            print(f"\t\tChecked {len(found)} Tops in {elapsed:.3f}s "
+                  f"({'sequentially' if workers <= 1 else f'on {workers} {executor} workers'})")
 
         print("\tChecking each top individually (no klass)")
-        for t in Top.objects.all():
-            test_top(t)
+        test_tops()
 
         print("\tChecking each top individually (klass 2)")
-        for t in Top.objects.all():
-            test_top(t,2)
+        test_tops(2)
 
         def test_query(klass=None, top=None, method=1):
             if method == 1:
@@ -181,20 +123,8 @@ class Command(BaseCommand):
                     Tops = Top.objects.annotate(high_rank_sums=Sum(Subquery(hr)))
 
             elif method == 2:
-                # This works, but aaargh, Raw SQL!
-                where_klass = "" if klass is None else f'WHERE M."klass"={klass}\n'
-                query = f"""
-                    SELECT id, name, SUM(max) AS high_rank_sums
-                    FROM
-                        (SELECT T."id" AS id, T."name" AS name, MAX(L."rank") AS max
-                         FROM "DjangoAnnotation_top" T
-                         INNER JOIN "DjangoAnnotation_middle" M ON M.reports_to_id = T.id
-                         INNER JOIN "DjangoAnnotation_lower" L ON L.reports_to_id = M.id
-                         {where_klass}GROUP BY T."id",T."name", L."name")
-                    GROUP BY id, name
-                """
-
-                Tops = Top.objects.raw(query)
+                # This works, but aaargh, Raw SQL! See DjangoAnnotation.strategies.sum_of_max_raw
+                Tops = sum_of_max_raw(klass)
 
             elif method == 3:
                 # This crashes with: django.core.exceptions.FieldError: Cannot compute Sum('max_rank'): 'max_rank' is an aggregate
@@ -256,20 +186,43 @@ class Command(BaseCommand):
                     ))
                 )
 
+            elif method == 8:
+                # A sum of maxima expression, which compiles to a correlated subquery doing the GROUP BY in the
+                # inner query and the SUM in the outer one. It keeps the QuerySet composable.
+                l_filter = None if klass is None else Q(middles__klass=klass)
+
+                Tops = Top.objects.annotate(
+                    high_rank_sums=SumOfMax('middles__lowers__rank', group_by='middles__lowers__name', filter=l_filter)
+                )
+                if not top is None:
+                    Tops = Tops.filter(id=top.id)
+
             # print(f"\t\tExpecting:")
             # for t in Tops:
-            #     print(f"\t\t\t{t.name}, {expected[t.name][klass]}")
+            #     print(f"\t\t\t{t.name}, {oracle.get(t, klass).high_rank_sums}")
 
             print(f"\t\tProduced:")
             for t in Tops:
-                status = "PASS" if  t.high_rank_sums == expected[t.name][klass] else "FAIL"
-                print(f"\t\t\t{t.name}, {t.high_rank_sums} expected {expected[t.name][klass]}    {status}")
+                expected = oracle.get(t, klass).high_rank_sums
+                status = "PASS" if  t.high_rank_sums == expected else "FAIL"
+                print(f"\t\t\t{t.name}, {t.high_rank_sums} expected {expected}    {status}")
 
 
-        method = 2
+        method = 8
         print("\tTrying a Queryset (no klass)")
         test_query( method=method)
 
         print("\tTrying a Queryset (klass 2)")
         #test_query(2, Top.objects.get(name="Jill Tuley"))
         test_query(2, method=method)
+
+    @staticmethod
+    def explain_strategies():
+        for name in STRATEGIES:
+            for klass in (None, 2):
+                SQL, plan = get_SQL(explain(name, klass), explain=True)
+                print(f"{name} ({'no klass' if klass is None else f'klass {klass}'}):")
+                print("\tSQL:")
+                print('\t\t' + SQL.replace('\n', '\n\t\t'))
+                print("\tQuery plan:")
+                print('\t\t' + format_plan(plan).replace('\n', '\n\t\t'))
@@ -0,0 +1,57 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import CommandError
+
+from DjangoAnnotation import sharding
+from DjangoAnnotation.models import Top
+from DjangoAnnotation.profiling import ProfiledCommand
+from DjangoAnnotation.strategies import mismatches
+
+
+class Command(ProfiledCommand):
+    help = ('Annotates every Top in every shard (see DjangoAnnotation.sharding), for any klass and each klass, with '
+            'the shards queried concurrently and the results merged, timing it with different numbers of shards '
+            'queried at once. Load the shards with load_data --sharded.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--strategy', choices=sharding.SHARDABLE, default='subqueries', help='The strategy run on each shard (default: subqueries).')
+        parser.add_argument('--workers', type=int, nargs='+',
+                            help='The numbers of shards to query at once, each timed (default: 1 and all of them).')
+        parser.add_argument('--repeat', type=int, default=3, help='The number of timed runs with each number of workers, the fastest being reported.')
+        parser.add_argument('--verify', action='store_true', help='Check the merged annotations against an Oracle of every shard.')
+
+    def handle(self, *args, **options):
+        if not settings.SHARDS:
+            raise CommandError("No shards are configured, set SHARDS (in settings or the environment)")
+        if options['repeat'] < 1:
+            raise CommandError("--repeat must be at least 1")
+        workers = options['workers'] or sorted({1, settings.SHARDS})
+        if min(workers) < 1:
+            raise CommandError("--workers must be at least 1")
+
+        strategy = options['strategy']
+        counts = sharding.on_shards(lambda alias: Top.objects.using(alias).count())
+        klasses = [None] + sharding.klasses()
+        print(f"{sum(counts)} Tops in {settings.SHARDS} shards ({', '.join(str(c) for c in counts)}), klasses {klasses[1:]}, annotated with {strategy}:")
+
+        for count in workers:
+            seconds = []
+            for run in range(options['repeat']):  # @UnusedVariable
+                start = time.perf_counter()
+                results = {klass: sharding.gather(strategy, klass, count) for klass in klasses}
+                seconds.append(time.perf_counter() - start)
+            print(f"\t{count:>3} at once: {min(seconds):8.3f}s, {sum(counts) * len(klasses) / min(seconds):10.0f} Top annotations/s")
+
+        if options['verify']:
+            start = time.perf_counter()
+            oracle = sharding.oracle()
+            wrong = {klass: mismatches(strategy, results[klass], oracle, klass) for klass in klasses}
+            print(f"Verified against the oracle in {time.perf_counter() - start:.3f}s")
+            for klass, mismatched in wrong.items():
+                for top, (got, expected) in sorted(mismatched.items()):
+                    print(f"\t{oracle.names.get(top, top)} (klass {klass}): {got} expected {expected}    FAIL")
+            failed = sum(len(mismatched) for mismatched in wrong.values())
+            if failed:
+                raise CommandError(f"{failed} Top annotations are wrong")
+            print("\tPASS")
@@ -0,0 +1,179 @@
+import csv
+import json
+import sys
+import time
+import tracemalloc
+
+from contextlib import contextmanager, nullcontext
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import CommandError
+from django.db import connection, connections, models
+
+from DjangoAnnotation import sqlite
+from DjangoAnnotation.models import Top, Middle, Lower
+from DjangoAnnotation.oracle import Oracle
+from DjangoAnnotation.profiling import ProfiledCommand, measure, measure_load
+from DjangoAnnotation.sql import get_plan, get_SQL
+from DjangoAnnotation.strategies import STRATEGIES, evaluate, explain, mismatches
+
+FIELDS = ('sqlite_profile', 'tops', 'middles', 'lowers', 'load_seconds', 'indexes', 'strategy', 'klass', 'cache', 'run', 'seconds', 'queries', 'rows', 'peak_kib', 'correct', 'sql', 'plan', 'plan_flags')
+
+# The indexes declared on the models for the aggregation paths, which --compare-indexes benchmarks without
+INDEXES = [(model, index) for model in (Top, Middle, Lower) for index in model._meta.indexes]
+
+# The indexes Django made on the foreign keys the covering indexes lead with, until they were declared
+# db_index=False, so that the schema benchmarked without the covering indexes is the one they replaced
+FK_INDEXES = [(model, models.Index(fields=['reports_to'], name=f'{model._meta.model_name}_reports_to_idx')) for model in (Middle, Lower)]
+
+
+@contextmanager
+def without_indexes():
+    '''
+    Replaces the indexes in INDEXES with those in FK_INDEXES for the duration of the context, putting them back on
+    exit, and brings the planner's statistics up to date each time.
+    '''
+    def replace(dropped, added):
+        with connection.schema_editor() as editor:
+            for model, index in dropped:
+                editor.remove_index(model, index)
+            for model, index in added:
+                editor.add_index(model, index)
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    replace(INDEXES, FK_INDEXES)
+    try:
+        yield
+    finally:
+        replace(FK_INDEXES, INDEXES)
+
+
+class Command(ProfiledCommand):
+    help = ('Benchmarks each annotation strategy against generated datasets of increasing size. '
+            'NB: Like load_data, this replaces the contents of the database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000],
+                            help='The number of Tops in each dataset generated (passed to load_data --tops).')
+        parser.add_argument('--middles', type=int, nargs=2, default=(1, 9), metavar=('MIN', 'MAX'))
+        parser.add_argument('--lowers', type=int, nargs=2, default=(1, 9), metavar=('MIN', 'MAX'))
+        parser.add_argument('--uniqueness', type=int, default=10)
+        parser.add_argument('--seed', type=int, default=1, help='Seed for the generated datasets, so runs are comparable.')
+        parser.add_argument('--keep-data', action='store_true',
+                            help="Don't generate datasets, benchmark the data already in the database.")
+        parser.add_argument('--strategies', nargs='+', choices=sorted(STRATEGIES), default=sorted(STRATEGIES))
+        parser.add_argument('--klass', type=int, nargs='*', default=[2],
+                            help='The klasses to benchmark, in addition to no klass (default: 2).')
+        parser.add_argument('--repeat', type=int, default=3, help='The number of warm runs after each cold run.')
+        parser.add_argument('--compare-indexes', action='store_true',
+                            help=f"Benchmark each dataset with and then without the indexes declared on the models ({', '.join(i.name for _, i in INDEXES)}), "
+                                 "with the foreign key indexes they replaced in their place.")
+        parser.add_argument('--sqlite-profiles', nargs='+', choices=sorted(settings.SQLITE_PROFILES), default=[settings.SQLITE_PROFILE],
+                            help=f"Benchmark loading and querying each dataset under each of these SQLite profiles (default: {settings.SQLITE_PROFILE}).")
+        parser.add_argument('--format', choices=('json', 'csv'), default='json')
+        parser.add_argument('--output', help='Write the report to this file rather than stdout.')
+
+    def handle(self, *args, **options):
+        if options['repeat'] < 0:
+            raise CommandError("--repeat can't be negative")
+
+        report = []
+        sizes = [None] if options['keep_data'] else options['sizes']
+        klasses = [None] + options['klass']
+
+        try:
+            for profile in options['sqlite_profiles']:
+                sqlite.activate(profile)
+                for size in sizes:
+                    self.bench_dataset(profile, size, klasses, report, options)
+        finally:
+            sqlite.activate(None)
+
+        self.write_report(report, options['format'], options['output'])
+
+    def bench_dataset(self, profile, size, klasses, report, options):
+        '''
+        Loads a dataset of size Tops (unless size is None), then benchmarks the strategies against it, adding
+        the results to the report.
+        '''
+        load_seconds = None
+        if size is not None:
+            load_seconds = measure_load(size, middles=options['middles'], lowers=options['lowers'],
+                                        uniqueness=options['uniqueness'], seed=options['seed']).seconds
+
+        dataset = {'sqlite_profile': profile, 'tops': Top.objects.count(), 'middles': Middle.objects.count(),
+                   'lowers': Lower.objects.count(), 'load_seconds': load_seconds}
+        self.stderr.write(f"Dataset: {dataset['tops']} Tops, {dataset['middles']} Middles, {dataset['lowers']} Lowers"
+                          f" ({profile} SQLite profile{'' if load_seconds is None else f', loaded in {load_seconds:.2f}s'})")
+        oracle = Oracle()
+
+        for indexes in ((True, False) if options['compare_indexes'] else (True,)):
+            if options['compare_indexes']:
+                self.stderr.write(f"\t{'With' if indexes else 'Without'} indexes:")
+            with (nullcontext() if indexes else without_indexes()):
+                for name in options['strategies']:
+                    for klass in klasses:
+                        for result in self.bench(name, klass, oracle, options['repeat']):
+                            report.append(dict(dataset, indexes=indexes, strategy=name, klass=klass, **result))
+                            self.stderr.write(f"\t{name:<24} klass={klass!s:<5} {result['cache']:<5} {result['seconds']:9.4f}s"
+                                              f" {result['queries']:>7} queries {result['rows']:>7} rows {result['peak_kib']:>9.0f} KiB"
+                                              f"{'' if result['correct'] else '    FAIL'}")
+                        if options['verbosity'] > 1:
+                            self.stderr.write(f"\t\t{result['plan']}")
+
+    @staticmethod
+    def bench(name, klass, oracle, repeat):
+        '''
+        Runs a strategy once on a cold connection then repeat times on a warm one, yielding a result for each run.
+
+        The timed runs are not instrumented. The queries issued, rows returned, peak Python memory and the
+        correctness of the results come from one extra instrumented run and are reported with every timed run,
+        as are the SQL and query plan (of the query explain() picks for the strategy).
+
+        A cold run starts from a new connection, with an empty SQLite page cache, and an empty Django cache (which
+        the cached strategies would otherwise answer from, filled by the instrumented run). The operating system's
+        file cache is not cleared, so a cold run measures the cost of SQLite reading pages it has in memory, not
+        disk IO.
+        '''
+        # So that the queries counted are those of a cached strategy's first run too
+        cache.clear()
+        tracemalloc.start()
+        try:
+            results, queries = measure(evaluate, name, klass, using=[connection.alias])[:2]
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        queryset = explain(name, klass)
+        plan = get_plan(queryset)
+        measures = {'queries': queries, 'rows': len(results), 'peak_kib': peak / 1024,
+                    'correct': not mismatches(name, results, oracle, klass),
+                    'sql': get_SQL(queryset),
+                    'plan': '; '.join(step.detail for step in plan),
+                    'plan_flags': '; '.join(flag for step in plan for flag in step.flags)}
+
+        for run in range(repeat + 1):
+            if run == 0:
+                connections.close_all()
+                cache.clear()
+            start = time.perf_counter()
+            evaluate(name, klass)
+            seconds = time.perf_counter() - start
+            yield dict(cache='cold' if run == 0 else 'warm', run=run, seconds=seconds, **measures)
+
+    @staticmethod
+    def write_report(report, fmt, output):
+        out = open(output, 'w', newline='') if output else sys.stdout
+        try:
+            if fmt == 'json':
+                json.dump(report, out, indent=2)
+                out.write('\n')
+            else:
+                writer = csv.DictWriter(out, fieldnames=FIELDS)
+                writer.writeheader()
+                writer.writerows(report)
+        finally:
+            if output:
+                out.close()
@@ -0,0 +1,94 @@
+import json
+import sys
+import time
+
+from django.core.management.base import CommandError
+from django.db import connection
+
+from DjangoAnnotation.models import Lower, Person
+from DjangoAnnotation.profiling import ProfiledCommand
+from DjangoAnnotation.strategies import evaluate
+
+# The ways of grouping Lowers by name: on the name itself, or on the Person it's interned as
+KEYS = ('name', 'person')
+
+# Whole table groupings, and the strategies that group each Top's Lowers, timed grouping on each key
+QUERIES = {
+    'highest_rank': 'SELECT {key}, MAX("rank") FROM {lower} GROUP BY {key}',
+    'rank_count': 'SELECT {key}, COUNT(*) FROM {lower} GROUP BY {key}',
+}
+STRATEGIES = {
+    'sum_of_max_raw': {'name': 'sum_of_max_raw', 'person': 'sum_of_max_raw_by_person'},
+    'subqueries': {'name': 'subqueries', 'person': 'subqueries_by_person'},
+    'denormalised_subqueries': {'name': 'denormalised_subqueries', 'person': 'denormalised_subqueries_by_person'},
+}
+
+
+class Command(ProfiledCommand):
+    help = ('Reports the storage taken by the Lower and Person tables and their indexes (from SQLite\'s dbstat), '
+            'and times grouping the Lowers by name against grouping them by Person, on the data in the database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=3, help='The number of runs of each query, the fastest being reported.')
+        parser.add_argument('--format', choices=('text', 'json'), default='text')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError("bench_grouping reads SQLite's dbstat table, it needs an SQLite database")
+        if options['repeat'] < 1:
+            raise CommandError("--repeat must be at least 1")
+
+        report = {'lowers': Lower.objects.count(), 'persons': Person.objects.count(), 'storage': self.storage(), 'timings': []}
+
+        lower = connection.ops.quote_name(Lower._meta.db_table)
+        for query, sql in QUERIES.items():
+            for key in KEYS:
+                column = connection.ops.quote_name(Lower._meta.get_field(key).column)
+                report['timings'].append(self.time(query, key, options['repeat'], self.run, sql.format(key=column, lower=lower)))
+        for klass in (None, 2):
+            for strategy, by_key in STRATEGIES.items():
+                for key in KEYS:
+                    name = strategy if klass is None else f'{strategy} (klass {klass})'
+                    report['timings'].append(self.time(name, key, options['repeat'], evaluate, by_key[key], klass))
+
+        if options['format'] == 'json':
+            json.dump(report, sys.stdout, indent=2)
+            sys.stdout.write('\n')
+            return
+
+        print(f"{report['lowers']} Lowers with {report['persons']} distinct names")
+        print("Storage (KiB):")
+        for name, kib in report['storage'].items():
+            print(f"\t{name:50} {kib:10,.0f}")
+        print("Fastest run (s):")
+        by_query = {}
+        for timing in report['timings']:
+            by_query.setdefault(timing['query'], {})[timing['key']] = timing['seconds']
+        for query, seconds in by_query.items():
+            print(f"\t{query:45} " + '   '.join(f"by {key} {seconds[key]:.3f}" for key in KEYS))
+
+    @staticmethod
+    def storage():
+        '''
+        The KiB taken by the Lower and Person tables and each of their indexes, by name.
+        '''
+        tables = [Lower._meta.db_table, Person._meta.db_table]
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT s.name, SUM(s.pgsize) FROM dbstat s JOIN sqlite_master m ON m.name = s.name "
+                           "WHERE m.tbl_name IN (%s, %s) GROUP BY s.name ORDER BY m.tbl_name, s.name", tables)
+            return {name: size / 1024 for name, size in cursor.fetchall()}
+
+    @staticmethod
+    def run(sql):
+        with connection.cursor() as cursor:
+            cursor.execute(sql)
+            return cursor.fetchall()
+
+    @staticmethod
+    def time(query, key, repeat, function, *args):
+        runs = []
+        for run in range(repeat):  # @UnusedVariable
+            start = time.perf_counter()
+            function(*args)
+            runs.append(time.perf_counter() - start)
+        return {'query': query, 'key': key, 'seconds': min(runs)}
@@ -0,0 +1,44 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import CommandError
+
+from DjangoAnnotation import denormalise, sharding
+from DjangoAnnotation.profiling import ProfiledCommand
+
+
+class Command(ProfiledCommand):
+    help = "Backfills and/or verifies the copies of each Lower's Top and klass (Lower.top and Lower.klass) against its Middle."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backfill', action='store_true', help="Copy the Top and klass of their Middle to the Lowers that differ.")
+        parser.add_argument('--verify', action='store_true', help='Count the Lowers that differ from their Middle (after backfilling if asked to).')
+        parser.add_argument('--database', nargs='+', choices=list(settings.DATABASES),
+                            help='The databases to work on (default: every shard if SHARDS is set, otherwise the default database).')
+
+    def handle(self, *args, **options):
+        if not (options['backfill'] or options['verify']):
+            raise CommandError("Nothing to do, use --backfill and/or --verify")
+        databases = options['database'] or sharding.databases()
+
+        if options['backfill']:
+            for alias in databases:
+                start = time.perf_counter()
+                updated = denormalise.backfill(using=alias)
+                print(f"Backfilled {updated} Lowers in {alias} in {time.perf_counter() - start:.2f}s")
+
+        if options['verify']:
+            failed = 0
+            for alias in databases:
+                start = time.perf_counter()
+                stale = denormalise.stale(using=alias)
+                wrong = stale.count()
+                print(f"Verified Lowers in {alias} in {time.perf_counter() - start:.2f}s")
+                if wrong:
+                    for lower, name, top, klass, middle_top, middle_klass in stale.values_list(
+                            'id', 'name', 'top', 'klass', 'reports_to__reports_to', 'reports_to__klass')[:20]:
+                        print(f"\tLower {lower} ({name}): Top {top} klass {klass} expected Top {middle_top} klass {middle_klass}    FAIL")
+                    failed += wrong
+            if failed:
+                raise CommandError(f"{failed} Lowers differ from their Middle")
+            print("\tPASS")
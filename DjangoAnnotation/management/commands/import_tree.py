@@ -0,0 +1,191 @@
+import csv
+import json
+import sys
+import time
+
+from collections import defaultdict
+
+from django.core.management.base import CommandError
+from django.db import connection, transaction
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+
+from DjangoAnnotation import cache, rollup
+from DjangoAnnotation.management.commands.list_data import FIELDS
+from DjangoAnnotation.models import Top, Middle, Lower, Person
+from DjangoAnnotation.profiling import ProfiledCommand
+from DjangoAnnotation.ranks import chunked, insert_lowers, rank_names
+
+
+def read_csv(source):
+    for row in csv.DictReader(source):
+        # CSV has no nulls, empty fields stand in for them
+        yield {field: row.get(field) or None for field in FIELDS}
+
+
+def read_jsonl(source):
+    for line in source:
+        if line.strip():
+            row = json.loads(line)
+            yield {field: row.get(field) for field in FIELDS}
+
+
+READERS = {'csv': read_csv, 'jsonl': read_jsonl}
+
+
+class Command(ProfiledCommand):
+    help = ('Imports a Top/Middle/Lower tree from a CSV or JSONL file of (top, middle, klass, lower, rank) rows, '
+            'as list_data writes them, adding it to the tree in the database. Tops are identified by name, and Middles '
+            'by name within their Top, so rows naming an existing Top or Middle are added to it. Lowers without a '
+            'rank are ranked as new Lowers are.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help="The file to import, or - to read stdin.")
+        parser.add_argument('--format', choices=sorted(READERS),
+                            help='The format of the file (by default taken from its extension).')
+        parser.add_argument('--batch-size', type=int, default=10000,
+                            help='The number of rows held in memory and written in each transaction.')
+        parser.add_argument('--progress', type=int, default=100000, metavar='ROWS',
+                            help='Report progress every this many rows (0 for no progress reports).')
+
+    def handle(self, *args, **options):
+        fmt = options['format']
+        if fmt is None:
+            fmt = options['file'].rsplit('.', 1)[-1].lower()
+            if fmt not in READERS:
+                raise CommandError(f"Can't tell the format of {options['file']}, use --format")
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be at least 1")
+
+        # The ids of the Tops and Middles by name, including those already in the database, so that rows are
+        # added to them. Middles are named within their Top. Where names are shared the oldest wins.
+        self.tops = {}
+        for top_id, name in Top.objects.order_by('-id').values_list('id', 'name').iterator():
+            self.tops[name] = top_id
+        self.middles = {}
+        # And the klass of each Middle by id, copied to its Lowers
+        self.klasses = {}
+        for middle_id, top_id, name, klass in Middle.objects.order_by('-id').values_list('id', 'reports_to_id', 'name', 'klass').iterator():
+            self.middles[(top_id, name)] = middle_id
+            self.klasses[middle_id] = klass
+
+        self.written = {'tops': 0, 'middles': 0, 'lowers': 0}
+        self.start = time.perf_counter()
+        rows = 0
+
+        try:
+            source = sys.stdin if options['file'] == '-' else open(options['file'], newline='')
+        except OSError as E:
+            raise CommandError(f"Can't read {options['file']}: {E.strerror}")
+        try:
+            # The signal handlers would refresh the rollups row by row, we refresh them once per batch
+            with rollup.suspended():
+                batch = []
+                for rows, row in enumerate(READERS[fmt](source), 1):
+                    batch.append(self.clean(row, rows))
+                    if len(batch) >= options['batch_size']:
+                        self.write(batch)
+                        batch = []
+                    if options['progress'] and rows % options['progress'] == 0:
+                        self.report(rows, "Read")
+                self.write(batch)
+        finally:
+            if source is not sys.stdin:
+                source.close()
+
+        # Give the query planner statistics on the new data
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+        if options['verbosity'] > 0:
+            self.report(rows, "Imported", final=True)
+
+    def report(self, rows, verb, final=False):
+        elapsed = time.perf_counter() - self.start
+        rate = rows / elapsed if elapsed else 0
+        added = (f" ({self.written['tops']} Tops, {self.written['middles']} Middles and {self.written['lowers']} Lowers added)"
+                 if final else "")
+        self.stderr.write(f"{verb} {rows} rows{added} in {elapsed:.2f}s ({rate:,.0f} rows/s)")
+
+    @staticmethod
+    def clean(row, line):
+        '''
+        Checks a row, converting klass and rank to ints.
+        '''
+        if not row['top']:
+            raise CommandError(f"Row {line} has no top")
+        if row['lower'] and not row['middle']:
+            raise CommandError(f"Row {line} has a lower but no middle")
+        try:
+            row['klass'] = 1 if row['klass'] is None else int(row['klass'])
+            row['rank'] = None if row['rank'] is None else int(row['rank'])
+        except ValueError as E:
+            raise CommandError(f"Row {line}: {E}")
+        return row
+
+    def write(self, batch):
+        '''
+        Writes a batch of rows in one transaction: the new Tops and Middles with bulk_create (which gives us their
+        ids) and the Lowers with executemany, which skips building a model instance for each of them.
+
+        The rollups of the Tops written to are refreshed, and the cache's table versions bumped, in the same
+        transaction, so a batch committed before a later one fails leaves neither stale.
+        '''
+        touched = set()
+        with transaction.atomic():
+            new_tops = {}
+            for row in batch:
+                if row['top'] not in self.tops and row['top'] not in new_tops:
+                    new_tops[row['top']] = Top(name=row['top'])
+            Top.objects.bulk_create(new_tops.values())
+            self.tops.update((name, top.id) for name, top in new_tops.items())
+
+            new_middles = {}
+            for row in batch:
+                if row['middle']:
+                    key = (self.tops[row['top']], row['middle'])
+                    if key not in self.middles and key not in new_middles:
+                        new_middles[key] = Middle(name=row['middle'], klass=row['klass'], reports_to_id=key[0])
+            Middle.objects.bulk_create(new_middles.values())
+            self.middles.update((key, middle.id) for key, middle in new_middles.items())
+            self.klasses.update((middle.id, middle.klass) for middle in new_middles.values())
+
+            ranked, unranked = [], []
+            for row in batch:
+                touched.add(self.tops[row['top']])
+                if row['lower']:
+                    top = self.tops[row['top']]
+                    middle = self.middles[(top, row['middle'])]
+                    if row['rank'] is None:
+                        unranked.append((row['lower'], middle, top, self.klasses[middle]))
+                    else:
+                        ranked.append((row['lower'], row['rank'], middle, top, self.klasses[middle]))
+
+            # Lowers with a rank go in first, and their names' counters are moved past the ranks, so the Lowers
+            # without one are ranked after them.
+            highest = {}
+            for name, rank, *_ in ranked:
+                highest[name] = max(rank, highest.get(name, rank))
+            Person.objects.bulk_create([Person(name=name) for name in highest], batch_size=500, ignore_conflicts=True)
+            # Ranks are small numbers shared by many names, so the names are moved past the same rank in one query
+            by_rank = defaultdict(list)
+            for name, rank in highest.items():
+                by_rank[rank].append(name)
+            for rank, names in by_rank.items():
+                for part in chunked(names, 500):
+                    Person.objects.filter(name__in=part).update(last_rank=Greatest(F('last_rank'), Value(rank)))
+            persons = {}
+            for part in chunked(highest, 500):
+                persons.update(Person.objects.filter(name__in=part).values_list('name', 'id'))
+            insert_lowers([(name, rank, middle, top, klass, persons[name]) for name, rank, middle, top, klass in ranked])
+
+            ranks = rank_names(name for name, *_ in unranked)
+            insert_lowers([(name, rank, middle, top, klass, person) for (name, middle, top, klass), (person, rank) in zip(unranked, ranks)])
+
+            self.written['tops'] += len(new_tops)
+            self.written['middles'] += len(new_middles)
+            self.written['lowers'] += len(ranked) + len(unranked)
+
+            for part in chunked(touched, 500):
+                rollup.refresh(part)
+            cache.bump(Top, Middle, Lower)
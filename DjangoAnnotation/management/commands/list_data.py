@@ -1,18 +1,77 @@
-import names
-import random
+import csv
+import json
+import sys
 
-from django.core.management.base import BaseCommand
-from django.db import connection
+from django.core.management.base import CommandError
+from django.db.models import Q
 
-from DjangoAnnotation.models import Top, Middle, Lower
+from DjangoAnnotation.models import Top
+from DjangoAnnotation.profiling import ProfiledCommand
 
+# The fields of each row in the machine readable formats, one row per Lower (or per childless Middle or Top)
+FIELDS = ('top', 'middle', 'klass', 'lower', 'rank')
 
-class Command(BaseCommand):
+
+class Command(ProfiledCommand):
+    help = 'Lists the Top/Middle/Lower tree, as an indented outline or as rows of (top, middle, klass, lower, rank).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', nargs='+', metavar='TOP', help='Only list these Tops (by id or name).')
+        parser.add_argument('--klass', type=int, help='Only list Middles of this klass (and the Tops that have them).')
+        parser.add_argument('--limit', type=int, help='List at most this many Tops.')
+        parser.add_argument('--format', choices=('text', 'jsonl', 'csv'), default='text')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='The number of rows fetched from the database at a time.')
 
     def handle(self, *args, **options):
-        for t in Top.objects.all():  # @UnusedVariable
-            print(f"{t.name}:")
-            for m in t.middles.all():  # @UnusedVariable
-                print(f"\t{m.name}, {m.klass}:")
-                for l in m.lowers.all():  # @UnusedVariable
-                    print(f"\t\t{l.name}, {l.rank}")
+        klass = options['klass']
+        limit = options['limit']
+        if limit is not None and limit < 0:
+            raise CommandError("--limit can't be negative")
+
+        # Select the Tops first, so that --limit counts Tops, not rows
+        tops = Top.objects.order_by('id')
+        if options['top']:
+            selected = Q()
+            for top in options['top']:
+                selected |= Q(id=int(top)) if top.isdigit() else Q(name=top)
+            tops = tops.filter(selected)
+        if klass is not None:
+            tops = tops.filter(middles__klass=klass).distinct()
+        if limit is not None:
+            tops = tops[:limit]
+
+        # Then the whole tree under them in one query, streamed in order so only a chunk is ever held in memory.
+        # Tops with no Middles, and Middles with no Lowers, come through the outer joins as NULLs.
+        rows = Top.objects.filter(id__in=tops.values('id'))
+        if klass is not None:
+            rows = rows.filter(middles__klass=klass)
+        rows = rows.order_by('id', 'middles__id', 'middles__lowers__id').values_list(
+            'id', 'name', 'middles__id', 'middles__name', 'middles__klass', 'middles__lowers__name', 'middles__lowers__rank')
+        rows = rows.iterator(chunk_size=options['chunk_size'])
+
+        {'text': self.write_text, 'jsonl': self.write_jsonl, 'csv': self.write_csv}[options['format']](rows, sys.stdout)
+
+    @staticmethod
+    def write_text(rows, out):
+        top = middle = None
+        for top_id, top_name, middle_id, middle_name, klass, lower, rank in rows:
+            if top_id != top:
+                top, middle = top_id, None
+                out.write(f"{top_name}:\n")
+            if middle_id is not None and middle_id != middle:
+                middle = middle_id
+                out.write(f"\t{middle_name}, {klass}:\n")
+            if lower is not None:
+                out.write(f"\t\t{lower}, {rank}\n")
+
+    @staticmethod
+    def write_jsonl(rows, out):
+        for top_id, top_name, middle_id, middle_name, klass, lower, rank in rows:  # @UnusedVariable
+            out.write(json.dumps(dict(zip(FIELDS, (top_name, middle_name, klass, lower, rank)))) + '\n')
+
+    @staticmethod
+    def write_csv(rows, out):
+        writer = csv.writer(out)
+        writer.writerow(FIELDS)
+        writer.writerows((top_name, middle_name, klass, lower, rank)
+                         for top_id, top_name, middle_id, middle_name, klass, lower, rank in rows)  # @UnusedVariable
@@ -1,59 +1,206 @@
+import bisect
 import names
 import random
+import time
 
-from django.core.management.base import BaseCommand
-from django.db import connection
+from collections import Counter
 
+from django.conf import settings
+from django.core.management.base import CommandError
+from django.db import connection, connections, transaction
+
+from DjangoAnnotation import cache, rollup, sharding
+from DjangoAnnotation.management.commands.reset_data import METHODS as RESETS, reset_fast
 from DjangoAnnotation.models import Top, Middle, Lower
+from DjangoAnnotation.profiling import ProfiledCommand
+from DjangoAnnotation.ranks import insert_lowers, rank_names
 
 
-class Command(BaseCommand):
+class NameGenerator:
+    '''
+    A fast stand in for names.get_full_name().
 
-    def handle(self, *args, **options):
+    names reads its distribution files from disk on every call, costing a few milliseconds a name,
+    which dominates the time taken to generate large trees. We read them once and pick from the
+    cumulative distributions with a bisection, which draws names with the same frequencies.
+    '''
+
+    def __init__(self):
+        self.first = {gender: self.load(names.FILES[f'first:{gender}']) for gender in ('male', 'female')}
+        self.last = self.load(names.FILES['last'])
+
+    @staticmethod
+    def load(filename):
+        found, cumulative = [], []
+        with open(filename) as name_file:
+            for line in name_file:
+                name, _, cummulative, _ = line.split()
+                found.append(name.capitalize())
+                cumulative.append(float(cummulative))
+        return found, cumulative
+
+    @staticmethod
+    def pick(distribution):
+        found, cumulative = distribution
+        i = bisect.bisect_right(cumulative, random.random() * 90)
+        return found[i] if i < len(found) else ""
+
+    def get_full_name(self):
+        first = self.first[random.choice(('male', 'female'))]
+        return f"{self.pick(first)} {self.pick(self.last)}"
+
+
+class Command(ProfiledCommand):
+    help = 'Replaces the contents of the database with a randomly generated Top/Middle/Lower tree.'
+
+    def add_arguments(self, parser):
         # define the tree
-        tops = 5
-        middles = (2, 10)
-        lowers = (2, 10)
+        parser.add_argument('--tops', type=int, default=5, help='The number of Tops to generate.')
+        parser.add_argument('--middles', type=int, nargs=2, default=(1, 9), metavar=('MIN', 'MAX'),
+                            help='The range of Middles reporting to each Top (inclusive).')
+        parser.add_argument('--lowers', type=int, nargs=2, default=(1, 9), metavar=('MIN', 'MAX'),
+                            help='The range of Lowers reporting to each Middle (inclusive).')
 
         # define the lower uniqueness
-        ulowers = 10
-        nlowers = tops * sum(middles)//2 * sum(lowers)//2 // ulowers
-        lower_names = [names.get_full_name() for _ in range(nlowers)]
+        parser.add_argument('--uniqueness', type=int, default=10,
+                            help='The number of Lowers per distinct Lower name (higher means more reuse of names and higher ranks).')
+
+        parser.add_argument('--reset', choices=sorted(RESETS), default='fast',
+                            help='How to empty the database first, see the reset_data command (default: fast).')
+        parser.add_argument('--seed', type=int, help='Seed the random number generator for a reproducible tree.')
+        parser.add_argument('--batch-size', type=int, default=10000,
+                            help='The number of Lowers held in memory and written in each bulk insert.')
+        parser.add_argument('--sharded', action='store_true',
+                            help='Write each Top, with its Middles and Lowers, to its shard (see DjangoAnnotation.sharding), needs SHARDS set.')
+
+    def handle(self, *args, **options):
+        tops = options['tops']
+        middles = options['middles']
+        lowers = options['lowers']
+        ulowers = options['uniqueness']
+        batch_size = options['batch_size']
+        verbose = options['verbosity'] > 1
+        sharded = options['sharded']
+
+        for arg, (low, high) in (('middles', middles), ('lowers', lowers)):
+            if not 0 <= low <= high:
+                raise CommandError(f"--{arg} needs 0 <= MIN <= MAX, got {low} {high}")
+        if ulowers < 1:
+            raise CommandError("--uniqueness must be at least 1")
+        if batch_size < 1:
+            raise CommandError("--batch-size must be at least 1")
+        if sharded and not settings.SHARDS:
+            raise CommandError("--sharded needs the shards configured, set SHARDS (in settings or the environment)")
+
+        if options['seed'] is not None:
+            random.seed(options['seed'])
 
-        # Start with a clean database
-        Top.objects.all().delete()
-        Middle.objects.all().delete()
-        Lower.objects.all().delete()
+        start = time.perf_counter()
 
-        # Ensure ID sequences are reset
+        # The pool of Lower names, which must be big enough to give every Middle unique Lower names.
+        generator = NameGenerator()
+        nlowers = max(tops * sum(middles) * sum(lowers) // 4 // ulowers, lowers[1], 1)
+        lower_names = set()
+        attempts = 0
+        while len(lower_names) < nlowers and attempts < 10 * nlowers:
+            lower_names.add(generator.get_full_name())
+            attempts += 1
+        lower_names = sorted(lower_names)
+        if len(lower_names) < lowers[1]:
+            raise CommandError(f"Could only generate {len(lower_names)} distinct Lower names, need {lowers[1]}")
+
+        # Start with a clean database. The rollups are rebuilt when we're done.
+        RESETS[options['reset']]()
+        if sharded:
+            sharding.migrate()
+            for alias in sharding.aliases():
+                reset_fast(alias)
+
+        # Objects waiting to be written. Middles are assigned their Top before it has a primary key,
+        # bulk_create picks up the Top's key when the Middles are written. Lowers wait as (name, Middle)
+        # pairs and are written as rows once their Middles have keys, building a model instance for each
+        # costing far more than writing it.
+        pending_tops, pending_middles, pending_lowers = [], [], []
+        written = Counter()
+        used_names = set()
+        # The ids of the Persons copied to each shard so far
+        copied = {}
+
+        # The objects waiting to be written in the order generated (Lowers by their index in pending_lowers),
+        # for printing once they're ranked
+        pending_tree = []
+
+        def flush():
+            # Each batch of Lowers is ranked in a few queries (see DjangoAnnotation.ranks)
+            ranks = rank_names(name for name, M in pending_lowers)
+            if sharded:
+                lowers = [Lower(name=name, rank=rank, person_id=person, reports_to=M, top=M.reports_to, klass=M.klass)
+                          for (name, M), (person, rank) in zip(pending_lowers, ranks)]
+                sharding.write(pending_tops, pending_middles, lowers, batch_size, copied)
+            else:
+                Top.objects.bulk_create(pending_tops, batch_size=batch_size)
+                Middle.objects.bulk_create(pending_middles, batch_size=batch_size)
+                insert_lowers([(name, rank, M.id, M.reports_to_id, M.klass, person)
+                               for (name, M), (person, rank) in zip(pending_lowers, ranks)])
+            written.update(tops=len(pending_tops), middles=len(pending_middles), lowers=len(pending_lowers))
+            used_names.update(name for name, M in pending_lowers)
+
+            for obj in pending_tree:
+                if isinstance(obj, Top):
+                    print(f"\t{obj.name}:")
+                elif isinstance(obj, Middle):
+                    print(f"\t\t{obj.name}, {obj.klass}:")
+                else:
+                    print(f"\t\t\t{pending_lowers[obj][0]}, {ranks[obj][1]}")
+            pending_tree.clear()
+
+            pending_tops.clear()
+            pending_middles.clear()
+            pending_lowers.clear()
+
+        if verbose:
+            print("Adding this data:")
+
+        with transaction.atomic():
+            for t in range(tops):
+                # Sharded Tops are routed on their id, so need it before they're written
+                T = Top(id=t + 1, name=generator.get_full_name()) if sharded else Top(name=generator.get_full_name())
+                pending_tops.append(T)
+                if verbose:
+                    pending_tree.append(T)
+                for m in range(random.randint(*middles)):  # @UnusedVariable
+                    M = Middle(name=generator.get_full_name(), klass=random.randint(1, 2), reports_to=T)
+                    pending_middles.append(M)
+                    if verbose:
+                        pending_tree.append(M)
+                    for name in random.sample(lower_names, random.randint(*lowers)):
+                        pending_lowers.append((name, M))
+                        if verbose:
+                            pending_tree.append(len(pending_lowers) - 1)
+
+                if len(pending_lowers) >= batch_size:
+                    flush()
+            flush()
+
+        # bulk_create sends no signals, so the rollups are built in one pass at the end and what's cached
+        # from the tables is invalidated
+        rollup.rebuild()
+        cache.bump(Top, Middle, Lower)
+
+        # Give the query planner statistics on the new data, without which SQLite prefers scanning
+        # tables to the covering indexes.
         with connection.cursor() as cursor:
-            def reset_sequence(model):
-                tbl = model._meta.db_table
-                sql = f"DELETE FROM `sqlite_sequence` WHERE `name` = '{tbl}';"
-                cursor.execute(sql)
-            reset_sequence(Top)
-            reset_sequence(Middle)
-            reset_sequence(Lower)
-
-        print("Adding this data:")
-        for t in range(tops):  # @UnusedVariable
-            T = Top(name=names.get_full_name())
-            T.save()
-            print(f"\t{T.name}:")
-            for m in range(middles[0], random.randint(middles[0]+1, middles[1]+1)):  # @UnusedVariable
-                M = Middle(name=names.get_full_name())
-                M.reports_to = T
-                M.klass = random.randint(1, 2)
-                M.save()
-                print(f"\t\t{M.name}, {M.klass}:")
-                used = set()
-                for l in range(lowers[0], random.randint(lowers[0]+1, lowers[1]+1)):  # @UnusedVariable
-                    name = random.choice(lower_names)
-                    while name in used:
-                        name = random.choice(lower_names)
-                    L = Lower(name=name)
-                    L.rank = Lower.objects.filter(name=L.name).count() + 1
-                    L.reports_to = M
-                    L.save()
-                    used.add(name)
-                    print(f"\t\t\t{L.name}, {L.rank}")
+            cursor.execute("ANALYZE")
+
+        if sharded:
+            for alias in sharding.aliases():
+                rollup.rebuild(using=alias)
+                with connections[alias].cursor() as cursor:
+                    cursor.execute("ANALYZE")
+
+        elapsed = time.perf_counter() - start
+        if options['verbosity'] > 0:
+            print(f"Added {written['tops']} Tops, {written['middles']} Middles and {written['lowers']} Lowers "
+                  f"({len(used_names)} distinct Lower names) in {elapsed:.2f}s"
+                  + (f" to {settings.SHARDS} shards" if sharded else "")
+                  + f", {written['lowers'] / elapsed:,.0f} Lowers/s")
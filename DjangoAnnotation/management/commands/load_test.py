@@ -0,0 +1,80 @@
+import asyncio
+import json
+import random
+import statistics
+import sys
+import time
+
+from django.core.management.base import CommandError
+from django.test import AsyncClient
+from django.test.utils import override_settings
+
+from DjangoAnnotation.models import Top
+from DjangoAnnotation.profiling import ProfiledCommand
+
+
+class Command(ProfiledCommand):
+    help = ('Load tests the async annotation views in process, through the ASGI handler, with increasing numbers '
+            'of concurrent clients, reporting the throughput and latency at each concurrency.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--urls', nargs='+', default=['/annotations/?limit=100', '/annotations/?klass=2&limit=100', '/annotations/{top}/?klass=2'],
+                            help='The URLs to request, in turn. {top} is replaced by a random Top id in each request.')
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32],
+                            help='The numbers of concurrent clients to test with.')
+        parser.add_argument('--requests', type=int, default=200, help='The number of requests made at each concurrency.')
+        parser.add_argument('--format', choices=('text', 'json'), default='text')
+
+    def handle(self, *args, **options):
+        if options['requests'] < 1 or min(options['concurrency']) < 1:
+            raise CommandError("--requests and --concurrency must be at least 1")
+
+        top_ids = list(Top.objects.values_list('id', flat=True))
+        if not top_ids and any('{top}' in url for url in options['urls']):
+            raise CommandError("There are no Tops to request, run load_data first")
+
+        results = []
+        for concurrency in options['concurrency']:
+            # The test client's requests are for the host testserver, as when run by the test runner
+            with override_settings(ALLOWED_HOSTS=['testserver']):
+                result = asyncio.run(self.run(options['urls'], top_ids, concurrency, options['requests']))
+            results.append(result)
+            if options['format'] == 'text':
+                print(f"{result['concurrency']:>4} clients: {result['requests']} requests in {result['seconds']:.2f}s, "
+                      f"{result['per_second']:8.1f}/s, latency ms p50 {result['p50_ms']:7.1f} p95 {result['p95_ms']:7.1f} "
+                      f"max {result['max_ms']:7.1f}, {result['errors']} errors")
+
+        if options['format'] == 'json':
+            json.dump(results, sys.stdout, indent=2)
+            sys.stdout.write('\n')
+
+    @staticmethod
+    async def run(urls, top_ids, concurrency, requests):
+        '''
+        Makes requests requests from concurrency clients, each making its next request when its last is answered.
+        '''
+        client = AsyncClient()
+        latencies = []
+        errors = 0
+        remaining = iter(range(requests))
+
+        async def worker():
+            nonlocal errors
+            for i in remaining:
+                url = urls[i % len(urls)].replace('{top}', str(random.choice(top_ids)) if top_ids else '')
+                start = time.perf_counter()
+                response = await client.get(url)
+                latencies.append(time.perf_counter() - start)
+                if response.status_code != 200:
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        seconds = time.perf_counter() - start
+
+        latencies.sort()
+        return {'concurrency': concurrency, 'requests': requests, 'errors': errors, 'seconds': seconds,
+                'per_second': requests / seconds,
+                'p50_ms': statistics.median(latencies) * 1000,
+                'p95_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000,
+                'max_ms': latencies[-1] * 1000}
@@ -0,0 +1,79 @@
+import time
+import tracemalloc
+
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
+
+from DjangoAnnotation import cache, rollup
+from DjangoAnnotation.models import Top, Middle, Lower, Person, TopRollup
+from DjangoAnnotation.profiling import ProfiledCommand
+
+# The tables to empty, children before their parents
+MODELS = (TopRollup, Lower, Middle, Top, Person)
+
+
+def reset_fast(using=DEFAULT_DB_ALIAS):
+    '''
+    Empties the tree with a DELETE per table, in one transaction, returning the number of rows deleted.
+
+    On delete Django emulates CASCADE in Python, collecting every related object (and, because the rollup and
+    cache signal handlers listen for deletes, loading each one into memory) before deleting them in batches.
+    Deleting children before parents needs none of that, and SQLite deletes all the rows of a table in one pass.
+    No signals are sent, so the rollups go too and the cache's table versions are bumped here.
+
+    :param using: The database to empty (a shard, see DjangoAnnotation.sharding), by default the default one
+    '''
+    deleted = 0
+    with transaction.atomic(using=using):
+        with connections[using].cursor() as cursor:
+            for model in MODELS:
+                cursor.execute(f"DELETE FROM {connections[using].ops.quote_name(model._meta.db_table)}")
+                deleted += cursor.rowcount
+            reset_sequences(cursor, using)
+        cache.bump()
+    return deleted
+
+
+def reset_cascade():
+    '''
+    Empties the tree with the ORM, letting Django cascade the deletes, returning the number of rows deleted.
+    '''
+    deleted = 0
+    with transaction.atomic():
+        # The rollups go with the Tops, no need to refresh them as they go
+        with rollup.suspended():
+            for model in (Top, Middle, Lower, Person):
+                deleted += model.objects.all().delete()[0]
+        with connection.cursor() as cursor:
+            reset_sequences(cursor)
+    return deleted
+
+
+def reset_sequences(cursor, using=DEFAULT_DB_ALIAS):
+    # So that the ids of new rows start at 1 again
+    if connections[using].vendor == 'sqlite':
+        tables = [model._meta.db_table for model in MODELS]
+        cursor.execute(f"DELETE FROM sqlite_sequence WHERE name IN ({', '.join(['%s'] * len(tables))})", tables)
+
+
+METHODS = {'fast': reset_fast, 'cascade': reset_cascade}
+
+
+class Command(ProfiledCommand):
+    help = 'Deletes all the Tops, Middles, Lowers, rollups and rank counters, reporting the time and memory taken.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--method', choices=sorted(METHODS), default='fast',
+                            help='fast: a DELETE per table, cascade: ORM deletes cascaded by Django (default: fast).')
+
+    def handle(self, *args, **options):
+        tracemalloc.start()
+        try:
+            start = time.perf_counter()
+            deleted = METHODS[options['method']]()
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        if options['verbosity'] > 0:
+            print(f"Deleted {deleted} rows ({options['method']}) in {elapsed:.2f}s, peak Python memory {peak / 2**20:.1f} MiB")
@@ -0,0 +1,44 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import CommandError
+
+from DjangoAnnotation import rollup, sharding
+from DjangoAnnotation.models import Top
+from DjangoAnnotation.profiling import ProfiledCommand
+
+
+class Command(ProfiledCommand):
+    help = 'Rebuilds the TopRollup table from scratch and/or verifies it against the live aggregates.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', help='Recompute every rollup.')
+        parser.add_argument('--verify', action='store_true', help='Compare every rollup with the live aggregates (after rebuilding if asked to).')
+        parser.add_argument('--database', nargs='+', choices=list(settings.DATABASES),
+                            help='The databases to work on (default: every shard if SHARDS is set, otherwise the default database).')
+
+    def handle(self, *args, **options):
+        if not (options['rebuild'] or options['verify']):
+            raise CommandError("Nothing to do, use --rebuild and/or --verify")
+        databases = options['database'] or sharding.databases()
+
+        if options['rebuild']:
+            for alias in databases:
+                start = time.perf_counter()
+                written = rollup.rebuild(using=alias)
+                print(f"Rebuilt {written} rollups in {alias} in {time.perf_counter() - start:.2f}s")
+
+        if options['verify']:
+            failed = 0
+            for alias in databases:
+                start = time.perf_counter()
+                wrong = rollup.verify(using=alias)
+                print(f"Verified rollups in {alias} in {time.perf_counter() - start:.2f}s")
+                if wrong:
+                    names = dict(Top.objects.using(alias).filter(id__in={top for top, _ in wrong}).values_list('id', 'name'))
+                    for (top, klass), (got, expected) in sorted(wrong.items(), key=lambda item: (item[0][0], item[0][1] or 0)):
+                        print(f"\t{names.get(top, top)} (klass {klass}): {got} expected {expected}    FAIL")
+                    failed += len(wrong)
+            if failed:
+                raise CommandError(f"{failed} rollups are wrong or missing")
+            print("\tPASS")
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.3 on 2026-10-18 09:33
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('DjangoAnnotation', '0005_lower_rank'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='lower',
+            index=models.Index(fields=['reports_to', 'name', 'rank'], name='lower_middle_name_rank_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='middle',
+            index=models.Index(fields=['reports_to', 'klass'], name='middle_top_klass_idx'),
+        ),
+        # The indexes above lead with reports_to, so the foreign keys' own indexes are redundant
+        migrations.AlterField(
+            model_name='lower',
+            name='reports_to',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='lowers', to='DjangoAnnotation.middle'),
+        ),
+        migrations.AlterField(
+            model_name='middle',
+            name='reports_to',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='middles', to='DjangoAnnotation.top'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.3 on 2026-10-18 09:46
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('DjangoAnnotation', '0006_lower_lower_middle_name_rank_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TopRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('klass', models.IntegerField(null=True)),
+                ('middle_count', models.IntegerField(default=0)),
+                ('lower_count', models.IntegerField(default=0)),
+                ('high_rank_sums', models.IntegerField(null=True)),
+                ('top', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='DjangoAnnotation.top')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='toprollup',
+            constraint=models.UniqueConstraint(fields=('top', 'klass'), name='toprollup_top_klass_uniq'),
+        ),
+    ]
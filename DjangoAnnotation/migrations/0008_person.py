@@ -0,0 +1,32 @@
+# Generated by Django 4.2.3 on 2026-10-18 09:47
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def count_ranks(apps, schema_editor):
+    # Each name's counter starts at the highest rank given to it so far
+    Lower = apps.get_model('DjangoAnnotation', 'Lower')
+    Person = apps.get_model('DjangoAnnotation', 'Person')
+    db = schema_editor.connection.alias
+    ranks = Lower.objects.using(db).values('name').annotate(last_rank=Max('rank')).order_by()
+    Person.objects.using(db).bulk_create([Person(name=r['name'], last_rank=r['last_rank']) for r in ranks.iterator()], batch_size=10000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('DjangoAnnotation', '0007_toprollup_toprollup_toprollup_top_klass_uniq'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Person',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=70, unique=True)),
+                ('last_rank', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(count_ranks, migrations.RunPython.noop),
+    ]
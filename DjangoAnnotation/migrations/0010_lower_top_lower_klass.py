@@ -0,0 +1,50 @@
+# Generated by Django 4.2.3 on 2026-10-18 10:35
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+import django.db.models.deletion
+
+
+def copy_from_middles(apps, schema_editor):
+    # Each Lower takes the Top and klass of its Middle
+    Middle = apps.get_model('DjangoAnnotation', 'Middle')
+    Lower = apps.get_model('DjangoAnnotation', 'Lower')
+    db = schema_editor.connection.alias
+    middle = Middle.objects.using(db).filter(pk=OuterRef('reports_to'))
+    Lower.objects.using(db).update(top=Subquery(middle.values('reports_to')[:1]), klass=Subquery(middle.values('klass')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('DjangoAnnotation', '0009_tableversion'),
+    ]
+
+    operations = [
+        # Added nullable, filled in, then made not null
+        migrations.AddField(
+            model_name='lower',
+            name='top',
+            field=models.ForeignKey(db_index=False, editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='lowers', to='DjangoAnnotation.top'),
+        ),
+        migrations.AddField(
+            model_name='lower',
+            name='klass',
+            field=models.IntegerField(editable=False, null=True),
+        ),
+        migrations.RunPython(copy_from_middles, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='lower',
+            name='top',
+            field=models.ForeignKey(db_index=False, editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='lowers', to='DjangoAnnotation.top'),
+        ),
+        migrations.AlterField(
+            model_name='lower',
+            name='klass',
+            field=models.IntegerField(editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='lower',
+            index=models.Index(fields=['top', 'klass', 'name', 'rank'], name='lower_top_klass_name_rank_idx'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 4.2.3 on 2026-10-18 11:02
+
+from django.db import migrations, models
+from django.db.models import Max, OuterRef, Subquery
+import django.db.models.deletion
+
+
+def intern_names(apps, schema_editor):
+    # Every name has a Person (made as Lowers are ranked), but in case one doesn't it gets one here, then each
+    # Lower refers to the Person of its name
+    Lower = apps.get_model('DjangoAnnotation', 'Lower')
+    Person = apps.get_model('DjangoAnnotation', 'Person')
+    db = schema_editor.connection.alias
+    ranks = Lower.objects.using(db).exclude(name__in=Person.objects.using(db).values('name')).values('name').annotate(last_rank=Max('rank')).order_by()
+    Person.objects.using(db).bulk_create([Person(name=r['name'], last_rank=r['last_rank']) for r in ranks.iterator()], batch_size=10000)
+    Lower.objects.using(db).update(person=Subquery(Person.objects.using(db).filter(name=OuterRef('name')).values('id')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('DjangoAnnotation', '0010_lower_top_lower_klass'),
+    ]
+
+    operations = [
+        # Added nullable, filled in, then made not null
+        migrations.AddField(
+            model_name='lower',
+            name='person',
+            field=models.ForeignKey(db_index=False, editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='lowers', to='DjangoAnnotation.person'),
+        ),
+        migrations.RunPython(intern_names, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='lower',
+            name='person',
+            field=models.ForeignKey(db_index=False, editable=False, on_delete=django.db.models.deletion.PROTECT, related_name='lowers', to='DjangoAnnotation.person'),
+        ),
+        migrations.AddIndex(
+            model_name='lower',
+            index=models.Index(fields=['reports_to', 'person', 'rank'], name='lower_middle_person_rank_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='lower',
+            index=models.Index(fields=['top', 'klass', 'person', 'rank'], name='lower_top_klass_person_idx'),
+        ),
+    ]
@@ -3,13 +3,78 @@ from django.db import models
 class Top(models.Model):
     name = models.CharField(max_length=70)
 
+    def __str__(self):
+        return self.name
+
 class Middle(models.Model):
     name = models.CharField(max_length=70)
     klass = models.IntegerField(default=1)
-    reports_to = models.ForeignKey(Top, related_name='middles', on_delete=models.CASCADE)
+    # Indexed by middle_top_klass_idx, which leads with it
+    reports_to = models.ForeignKey(Top, related_name='middles', on_delete=models.CASCADE, db_index=False)
+
+    class Meta:
+        indexes = [
+            # Finds the Middles of a Top, of a given klass, without visiting the table
+            models.Index(fields=['reports_to', 'klass'], name='middle_top_klass_idx'),
+        ]
+
+    def __str__(self):
+        return self.name
 
 class Lower(models.Model):
     name = models.CharField(max_length=70)
     rank = models.IntegerField(default=1)
-    reports_to = models.ForeignKey(Middle, related_name='lowers', on_delete=models.CASCADE)
+    # Indexed by lower_middle_name_rank_idx, which leads with it
+    reports_to = models.ForeignKey(Middle, related_name='lowers', on_delete=models.CASCADE, db_index=False)
+    # Copies of the Top and klass of the Middle reported to, so that the Lowers of a Top can be aggregated
+    # without joining Middle, kept in step by DjangoAnnotation.denormalise. The index below leads with top.
+    top = models.ForeignKey(Top, related_name='lowers', on_delete=models.CASCADE, db_index=False, editable=False)
+    klass = models.IntegerField(editable=False)
+    # The Person of the Lower's name, so that Lowers can be grouped by name on an integer rather than a string.
+    # Set as Lowers are ranked (see DjangoAnnotation.ranks) or saved (see DjangoAnnotation.denormalise).
+    person = models.ForeignKey('Person', related_name='lowers', on_delete=models.PROTECT, db_index=False, editable=False)
+
+    class Meta:
+        indexes = [
+            # Covers the grouping of a Middle's Lowers by name to take the Max of rank
+            models.Index(fields=['reports_to', 'name', 'rank'], name='lower_middle_name_rank_idx'),
+            # Covers the same grouping of a Top's Lowers (of a klass), from Lower alone
+            models.Index(fields=['top', 'klass', 'name', 'rank'], name='lower_top_klass_name_rank_idx'),
+            # The same two groupings, by Person rather than name
+            models.Index(fields=['reports_to', 'person', 'rank'], name='lower_middle_person_rank_idx'),
+            models.Index(fields=['top', 'klass', 'person', 'rank'], name='lower_top_klass_person_idx'),
+        ]
+
+    def __str__(self):
+        return self.name
+
+class Person(models.Model):
+    # A Lower name and the rank given to the last Lower of that name, so that new Lowers can be
+    # ranked without counting the Lowers with their name (see DjangoAnnotation.ranks). Lowers refer
+    # to the Person of their name, which interns the names.
+    name = models.CharField(max_length=70, unique=True)
+    last_rank = models.IntegerField(default=0)
+
+    def __str__(self):
+        return self.name
+
+class TopRollup(models.Model):
+    # The annotations of a Top for a klass of Middle (or any klass when klass is None), kept up
+    # to date by DjangoAnnotation.rollup so they can be read without aggregating Lowers.
+    top = models.ForeignKey(Top, related_name='rollups', on_delete=models.CASCADE)
+    klass = models.IntegerField(null=True)
+    middle_count = models.IntegerField(default=0)
+    lower_count = models.IntegerField(default=0)
+    high_rank_sums = models.IntegerField(null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['top', 'klass'], name='toprollup_top_klass_uniq'),
+        ]
 
+class TableVersion(models.Model):
+    # A counter bumped whenever the contents of a table change, so that what's cached from the table
+    # can be keyed on its version and never served stale (see DjangoAnnotation.cache).
+    table = models.CharField(max_length=100, unique=True)
+    version = models.PositiveBigIntegerField(default=0)
+    modified = models.DateTimeField(auto_now=True)
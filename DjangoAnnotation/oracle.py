@@ -0,0 +1,87 @@
+'''
+The annotations we expect on each Top, computed in Python so that the ORM annotations can be checked against them.
+
+Walking Top.objects.all() -> T.middles.all() -> M.lowers.all() costs a query per Top and per Middle. Instead we
+stream the whole Top/Middle/Lower join once, ordered by Top, and roll each Top up as we pass it. Only one Top's
+worth of rows is ever held in memory and every klass is rolled up in the same pass.
+'''
+from collections import namedtuple
+
+from DjangoAnnotation.models import Top
+
+Annotations = namedtuple('Annotations', ('middle_count', 'lower_count', 'high_rank_sums'))
+
+# What we expect of a Top with no Middles (of a given klass)
+NO_ANNOTATIONS = Annotations(0, 0, None)
+
+
+class Oracle:
+    '''
+    Expected annotations for every Top (or a selection of them) and for every klass.
+
+    After construction:
+        names        is a dict of Top names keyed on Top id, in Top id order
+        annotations  is a dict keyed on Top id, of dicts keyed on klass (None meaning any klass) of Annotations
+        klasses      is a sorted list of the Middle klasses seen
+    '''
+
+    def __init__(self, tops=None, chunk_size=2000, using=None):
+        '''
+        :param tops:        Optionally, an iterable of Tops or Top ids to limit the oracle to.
+        :param chunk_size:  The number of rows fetched from the database at a time.
+        :param using:       The database to read, by default the one the routers choose (see DjangoAnnotation.sharding).
+        '''
+        self.names = {}
+        self.annotations = {}
+        klasses = set()
+
+        rows = Top.objects.using(using).order_by('id')
+        if tops is not None:
+            rows = rows.filter(id__in=[getattr(t, 'pk', t) for t in tops])
+        rows = rows.values_list('id', 'name', 'middles__id', 'middles__klass', 'middles__lowers__name', 'middles__lowers__rank')
+
+        top = None
+        for top_id, top_name, middle, klass, lower, rank in rows.iterator(chunk_size=chunk_size):
+            if top_id != top:
+                if top is not None:
+                    self.annotations[top] = self.rollup(tally)
+                top = top_id
+                self.names[top_id] = top_name
+                # Per klass (and None for any klass): the set of Middle ids, the count of Lowers and a dict
+                # of the highest rank seen for each Lower name.
+                tally = {None: (set(), [0], {})}
+
+            # Tops with no Middles, and Middles with no Lowers, come through the outer joins as NULLs.
+            if middle is None:
+                continue
+
+            klasses.add(klass)
+            if klass not in tally:
+                tally[klass] = (set(), [0], {})
+
+            for k in (None, klass):
+                middles, lowers, highest = tally[k]
+                middles.add(middle)
+                if lower is not None:
+                    lowers[0] += 1
+                    if rank > highest.get(lower, rank - 1):
+                        highest[lower] = rank
+
+        if top is not None:
+            self.annotations[top] = self.rollup(tally)
+
+        self.klasses = sorted(klasses)
+
+    @staticmethod
+    def rollup(tally):
+        return {klass: Annotations(len(middles), lowers[0], sum(highest.values()) if highest else None)
+                for klass, (middles, lowers, highest) in tally.items()}
+
+    def get(self, top, klass=None):
+        '''
+        The Annotations expected on a given Top.
+
+        :param top:    A Top or Top id
+        :param klass:  The klass of Middle to restrict the annotations to (None for any klass)
+        '''
+        return self.annotations[getattr(top, 'pk', top)].get(klass, NO_ANNOTATIONS)
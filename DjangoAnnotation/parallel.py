@@ -0,0 +1,90 @@
+'''
+Runs per-Top queries on a pool of workers.
+
+Checking each Top with a query of its own (as the annotate command's test_top does) is a round trip per Top, and
+run in a loop the database sits idle while Python handles each result. Here the Tops are partitioned into chunks
+that are checked concurrently on a pool of threads or processes, each worker with its own database connection.
+
+SQLite releases the GIL while it runs a query, so threads overlap the query time of one Top with the Python time
+of others. Processes also run the Python in parallel, at the cost of starting them and shipping results back.
+'''
+import math
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+import django
+
+from django.db import connections
+from django.db.models import Sum
+
+from DjangoAnnotation.models import Top
+from DjangoAnnotation.strategies import highest_ranks
+
+EXECUTORS = {'thread': ThreadPoolExecutor, 'process': ProcessPoolExecutor}
+
+
+def chunks(items, count):
+    '''
+    Splits a list into (at most) count chunks of near equal size.
+    '''
+    size = max(1, math.ceil(len(items) / count)) if items else 1
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def init_worker():
+    # A spawned process starts with nothing set up (a forked one has it all already)
+    django.setup()
+
+
+def check_top(top, klass=None, denormalised=False):
+    '''
+    The sum of the highest ranks of a Top (or Top id) and the highest ranks themselves, from a grouped Max query
+    and an aggregate Sum query (see strategies.highest_ranks for denormalised).
+    '''
+    top_highest_ranks = highest_ranks(top, klass, denormalised)
+    return top_highest_ranks.aggregate(total=Sum('highest_rank'))['total'], list(top_highest_ranks)
+
+
+def check_tops(tops, klass=None, denormalised=False):
+    '''
+    check_top for each of a list of Top ids, in a worker, returning a dict of the results keyed on Top id.
+    '''
+    try:
+        return {top: check_top(top, klass, denormalised) for top in tops}
+    finally:
+        # A worker's connection is its own, and we don't leave it open when the worker's done with it
+        connections.close_all()
+
+
+def per_top(klass=None, tops=None, workers=1, executor='thread', chunks_per_worker=4, denormalised=False):
+    '''
+    Runs check_top on every Top (or a selection of them), returning a dict of the results keyed on Top id.
+
+    :param klass:              The klass of Middle to restrict the highest ranks to (None for any klass)
+    :param tops:               Optionally, an iterable of Tops or Top ids to check, by default all of them
+    :param workers:            The number of workers to run, 1 runs check_top in this thread
+    :param executor:           'thread' or 'process', the kind of worker
+    :param chunks_per_worker:  The number of chunks to split the Tops into per worker, more balancing the load
+                               better and fewer costing fewer connections
+    :param denormalised:       Find each Top's Lowers by their copies of their Middle's Top and klass
+    '''
+    if tops is None:
+        tops = list(Top.objects.order_by('id').values_list('id', flat=True))
+    else:
+        tops = [getattr(t, 'pk', t) for t in tops]
+
+    if workers <= 1:
+        return {top: check_top(top, klass, denormalised) for top in tops}
+
+    if executor == 'process':
+        # Forked workers mustn't share the parent's connections
+        connections.close_all()
+
+    pool = EXECUTORS[executor]
+    options = {'initializer': init_worker} if executor == 'process' else {}
+    found = {}
+    with pool(max_workers=workers, **options) as workers_pool:
+        for result in workers_pool.map(partial(check_tops, klass=klass, denormalised=denormalised), chunks(tops, workers * chunks_per_worker)):
+            found.update(result)
+    return found
@@ -0,0 +1,182 @@
+'''
+Opt-in instrumentation of the SQL a block of code (or a management command) runs.
+
+QueryProfiler is a context manager that installs an execute wrapper on the database connections, recording
+the time taken by every statement and grouping statements by shape (the SQL with literals and IN lists
+collapsed), so N+1 patterns show up as one shape repeated many times. Commands built on ProfiledCommand get a
+--profile option that prints a summary of the slowest and most repeated shapes when the command ends.
+
+measure() runs a function in a QueryProfiler, counting its queries and timing it, and measure_load() so measures
+loading a generated tree, for the benchmarks and the performance tests.
+
+Connections are per thread, so only queries run in the thread that entered the profiler are recorded.
+'''
+import re
+import time
+
+from collections import namedtuple
+from contextlib import ExitStack
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+re_in_list = re.compile(r'\(\s*%s(?:\s*,\s*%s)*\s*\)')
+re_rows = re.compile(r'(?:\(%s, \.\.\.\)\s*,\s*)+\(%s, \.\.\.\)')
+re_string = re.compile(r"'(?:[^']|'')*'")
+re_number = re.compile(r'(?<![\w"])-?\d+(?:\.\d+)?\b')
+re_space = re.compile(r'\s+')
+
+
+def shape(sql):
+    '''
+    The shape of an SQL statement: its text with literals replaced by ? and lists of parameters (and of rows of them) collapsed,
+    so that statements differing only in their values have the same shape.
+    '''
+    sql = re_in_list.sub('(%s, ...)', sql)
+    sql = re_rows.sub('(%s, ...), ...', sql)
+    sql = re_string.sub('?', sql)
+    sql = re_number.sub('?', sql)
+    return re_space.sub(' ', sql).strip()
+
+
+class Shape:
+    '''
+    The statements of one shape that a QueryProfiler recorded.
+    '''
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.count = 0
+        self.seconds = 0.0
+        self.slowest = 0.0
+
+    @property
+    def mean(self):
+        return self.seconds / self.count if self.count else 0.0
+
+
+class QueryProfiler:
+    '''
+    Records the SQL run in its context, on all the configured databases (or those named).
+
+        with QueryProfiler() as profiler:
+            ...
+        print(profiler.summary())
+
+    :param using: The database aliases to profile, by default all of them.
+    '''
+
+    def __init__(self, using=None):
+        self.using = using
+        self.shapes = {}
+        self.count = 0
+        self.seconds = 0.0
+        self.elapsed = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            seconds = time.perf_counter() - start
+            key = shape(sql)
+            if key not in self.shapes:
+                self.shapes[key] = Shape(key)
+            stats = self.shapes[key]
+            stats.count += 1
+            stats.seconds += seconds
+            stats.slowest = max(stats.slowest, seconds)
+            self.count += 1
+            self.seconds += seconds
+
+    def __enter__(self):
+        self.stack = ExitStack()
+        for alias in (self.using or connections):
+            self.stack.enter_context(connections[alias].execute_wrapper(self))
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.perf_counter() - self.start
+        return self.stack.__exit__(*exc_info)
+
+    @property
+    def repeats(self):
+        '''
+        The number of statements that repeated the shape of an earlier statement.
+        '''
+        return sum(s.count - 1 for s in self.shapes.values())
+
+    def summary(self, top=10, width=100):
+        '''
+        A summary table of the recorded statements: the slowest shapes by total time and the most repeated shapes.
+
+        :param top:   The number of shapes to list in each table
+        :param width: The width to truncate the SQL to
+        '''
+        def table(title, shapes):
+            lines = [title, f"\t{'count':>7} {'total s':>9} {'mean ms':>9} {'max ms':>9}  SQL"]
+            for s in shapes[:top]:
+                sql = s.sql if len(s.sql) <= width else s.sql[:width - 3] + '...'
+                lines.append(f"\t{s.count:>7} {s.seconds:>9.4f} {s.mean * 1000:>9.3f} {s.slowest * 1000:>9.3f}  {sql}")
+            return lines
+
+        shapes = list(self.shapes.values())
+        lines = [f"{self.count} queries ({len(shapes)} shapes, {self.repeats} repeats) took {self.seconds:.4f}s "
+                 f"of {self.elapsed:.4f}s elapsed"]
+        if shapes:
+            lines += table("Slowest shapes:", sorted(shapes, key=lambda s: s.seconds, reverse=True))
+            lines += table("Most repeated shapes:", sorted(shapes, key=lambda s: s.count, reverse=True))
+        return '\n'.join(lines)
+
+
+Measurement = namedtuple('Measurement', ('returned', 'queries', 'seconds'))
+
+
+def measure(function, *args, using=None, **kwargs):
+    '''
+    Runs function(*args, **kwargs), returning what it returned, the number of queries it ran and the seconds it took.
+
+    :param using: The database aliases to count the queries on, by default all of them.
+    '''
+    # QueryProfiler rather than CaptureQueriesContext, which stops recording after 9000 queries
+    with QueryProfiler(using=using) as queries:
+        start = time.perf_counter()
+        returned = function(*args, **kwargs)
+        seconds = time.perf_counter() - start
+    return Measurement(returned, queries.count, seconds)
+
+
+def measure_load(tops, **options):
+    '''
+    Replaces the contents of the database with a generated tree of tops Tops, measuring the load_data that loads it.
+
+    :param options: Passed to load_data (middles, lowers, uniqueness, seed and the like)
+    '''
+    # Empty the database first, so that the time taken to load isn't skewed by the size of the last tree
+    call_command('load_data', tops=0, verbosity=0)
+    return measure(call_command, 'load_data', tops=tops, verbosity=0, **options)
+
+
+class ProfiledCommand(BaseCommand):
+    '''
+    A management command with a --profile option that prints a QueryProfiler summary (to stderr) when it ends.
+    '''
+
+    def create_parser(self, prog_name, subcommand, **kwargs):
+        parser = super().create_parser(prog_name, subcommand, **kwargs)
+        parser.add_argument('--profile', action='store_true',
+                            help='Record the SQL the command runs and print the slowest and most repeated queries at the end.')
+        return parser
+
+    def execute(self, *args, **options):
+        if not options.get('profile'):
+            return super().execute(*args, **options)
+
+        profiler = QueryProfiler()
+        try:
+            with profiler:
+                return super().execute(*args, **options)
+        finally:
+            self.stderr.write(profiler.summary())
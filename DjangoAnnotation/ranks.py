@@ -0,0 +1,120 @@
+'''
+Assigns ranks to new Lowers.
+
+The rank of a Lower is one more than the rank of the last Lower given its name. Counting the Lowers with a
+name for every new Lower costs a query that gets slower as the table grows, and two concurrent inserts can
+count the same Lowers and give out the same rank. Instead each name has a Person, holding the last rank given
+to it, and a batch of Lowers is ranked by incrementing those counters in place, in a few queries per batch
+whatever its size. Each Lower is given the Person of its name as it's ranked.
+'''
+from collections import Counter
+
+from django.db import connections, router, transaction
+from django.db.models.constants import OnConflict
+
+from DjangoAnnotation import cache, denormalise, rollup
+from DjangoAnnotation.models import Person, Middle, Lower
+
+
+def chunked(items, size):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def rank_names(names, using=None):
+    '''
+    Reserves the next ranks for a batch of new Lowers by name, in the order given, in the Person counters. Returns a
+    list of (Person id, rank) tuples, one for each name, so that Lowers can be ranked (and written, see
+    insert_lowers) without a model instance for each of them.
+
+    Call this in the transaction that saves the Lowers, so that the ranks are released if they aren't saved. The
+    counters are incremented before they are read, so the rows are locked (the whole database on SQLite) by the
+    time we read them and concurrent batches get distinct ranks.
+
+    :param names: An iterable of Lower names
+    :param using: The database alias, by default the one the router picks for writing Lowers
+    '''
+    names = list(names)
+    using = using or router.db_for_write(Lower)
+    connection = connections[using]
+    counts = Counter(names)
+    chunk = connection.ops.bulk_batch_size(['name'], list(counts)) or len(counts)
+
+    # Each statement is run for every name at once with executemany, or for as many names as fit in one, which
+    # saves the ORM building a QuerySet (and Person instances) for each
+    quote = connection.ops.quote_name
+    table = quote(Person._meta.db_table)
+    name_column, id_column, rank_column = (quote(Person._meta.get_field(f).column) for f in ('name', 'id', 'last_rank'))
+    # The Persons of new names are made, skipping those that exist
+    insert = (f"{connection.ops.insert_statement(on_conflict=OnConflict.IGNORE)} {table} ({name_column}, {rank_column}) VALUES (%s, 0) "
+              f"{connection.ops.on_conflict_suffix_sql([Person._meta.get_field('name')], OnConflict.IGNORE, None, None)}")
+
+    persons = {}
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        cursor.executemany(insert, [(name,) for name in counts])
+        cursor.executemany(f"UPDATE {table} SET {rank_column} = {rank_column} + %s WHERE {name_column} = %s", [(count, name) for name, count in counts.items()])
+        for part in chunked(counts, chunk):
+            cursor.execute(f"SELECT {name_column}, {id_column}, {rank_column} FROM {table} WHERE {name_column} IN ({', '.join(['%s'] * len(part))})", part)
+            persons.update((name, (person, last_rank)) for name, person, last_rank in cursor.fetchall())
+
+    # Hand out the reserved ranks, the last of them being the one now recorded
+    ranked = []
+    for name in names:
+        person, last_rank = persons[name]
+        ranked.append((person, last_rank - counts[name] + 1))
+        counts[name] -= 1
+    return ranked
+
+
+def assign_ranks(lowers, using=None):
+    '''
+    Assigns the next ranks to a batch of unsaved Lowers, in the order given, reserving them in the Person counters
+    (see rank_names), and the Person of each Lower's name.
+
+    :param lowers: An iterable of unsaved Lowers
+    :param using:  The database alias, by default the one the router picks for writing Lowers
+    '''
+    lowers = list(lowers)
+    for lower, (person, rank) in zip(lowers, rank_names((lower.name for lower in lowers), using)):
+        lower.person_id, lower.rank = person, rank
+    return lowers
+
+
+def insert_lowers(rows, using=None):
+    '''
+    Inserts Lowers given as (name, rank, reports_to id, top id, klass, Person id) tuples with one executemany,
+    skipping the model instance bulk_create builds for each of them (and sending no signals, as bulk_create doesn't).
+
+    :param rows:  A list of tuples
+    :param using: The database alias, by default the one the router picks for writing Lowers
+    '''
+    if rows:
+        connection = connections[using or router.db_for_write(Lower)]
+        table = connection.ops.quote_name(Lower._meta.db_table)
+        columns = ', '.join(connection.ops.quote_name(Lower._meta.get_field(f).column) for f in ('name', 'rank', 'reports_to', 'top', 'klass', 'person'))
+        with connection.cursor() as cursor:
+            cursor.executemany(f"INSERT INTO {table} ({columns}) VALUES (%s, %s, %s, %s, %s, %s)", rows)
+
+
+def create_lowers(lowers, batch_size=None, using=None):
+    '''
+    Ranks and bulk creates a batch of unsaved Lowers in one transaction, returning them.
+
+    bulk_create sends no signals, so the Lowers are given the Top and klass of their Middles, the TopRollups of the
+    Middles the Lowers report to are refreshed, and the version of the Lower table the annotation cache is keyed
+    on is bumped, here.
+
+    :param lowers:      An iterable of unsaved Lowers
+    :param batch_size:  Passed to bulk_create
+    :param using:       The database alias, by default the one the router picks for writing Lowers
+    '''
+    lowers = list(lowers)
+    using = using or router.db_for_write(Lower)
+    with transaction.atomic(using=using):
+        assign_ranks(lowers, using=using)
+        denormalise.fill(lowers, using=using)
+        Lower.objects.using(using).bulk_create(lowers, batch_size=batch_size)
+        rollup.refresh(Middle.objects.using(using).filter(id__in={l.reports_to_id for l in lowers}).values_list('reports_to_id', flat=True), using)
+        cache.bump(Lower)
+    return lowers
@@ -0,0 +1,173 @@
+'''
+Maintains TopRollup, the denormalised annotations of each Top per klass, so that reading them is a single row
+lookup rather than an aggregation over every Lower under the Top.
+
+Saving or deleting a Middle or Lower marks the Tops it reported (and now reports) to as dirty, as does creating
+a Top (which has the rollup of a Top with no Middles), and the dirty Tops are refreshed in one batch when the
+transaction commits (immediately in autocommit mode). A refresh recomputes the rollups of the dirty Tops from
+scratch with the Oracle, in one query, because the sum of the highest ranks can't be adjusted incrementally when
+a Lower is deleted.
+
+Bulk operations (bulk_create, QuerySet.update and the like) send no signals. Code that uses them should
+refresh() the Tops it touched or rebuild() the lot, and can suspend the signal handlers while it works with
+suspended().
+'''
+import threading
+
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
+from django.dispatch import receiver
+
+from DjangoAnnotation import cache
+from DjangoAnnotation.models import Top, Middle, Lower, TopRollup
+from DjangoAnnotation.oracle import Annotations, Oracle
+
+# Per thread: the dirty Tops and the Middles whose Top is dirty (each keyed on database alias, as the tree may be
+# sharded across databases, see DjangoAnnotation.sharding) and whether the signal handlers are suspended.
+state = threading.local()
+
+
+def pending():
+    if not hasattr(state, 'tops'):
+        state.tops = defaultdict(set)
+        state.middles = defaultdict(set)
+        state.suspended = 0
+    return state
+
+
+def rollups(oracle):
+    '''
+    The TopRollups for every Top and klass an Oracle holds.
+    '''
+    return [TopRollup(top_id=top, klass=klass, **annotations._asdict())
+            for top, by_klass in oracle.annotations.items()
+            for klass, annotations in by_klass.items()]
+
+
+def refresh(tops, using=None):
+    '''
+    Recomputes the rollups of some Tops.
+
+    :param tops:  An iterable of Tops or Top ids. Tops that no longer exist are ignored.
+    :param using: The database the Tops are in, by default the routers' choice
+    '''
+    tops = {getattr(t, 'pk', t) for t in tops}
+    if tops:
+        oracle = Oracle(tops=tops, using=using)
+        with transaction.atomic(using=using):
+            TopRollup.objects.using(using).filter(top__in=tops).delete()
+            TopRollup.objects.using(using).bulk_create(rollups(oracle))
+            cache.bump(TopRollup)
+
+
+def rebuild(batch_size=10000, using=None):
+    '''
+    Recomputes the rollups of every Top, returning the number of rollups written.
+
+    :param using: The database to rebuild them in (a shard, see DjangoAnnotation.sharding), by default the routers' choice
+    '''
+    oracle = Oracle(using=using)
+    with transaction.atomic(using=using):
+        TopRollup.objects.using(using).all().delete()
+        written = len(TopRollup.objects.using(using).bulk_create(rollups(oracle), batch_size=batch_size))
+        cache.bump(TopRollup)
+    return written
+
+
+def verify(using=None):
+    '''
+    Compares the rollups with the live aggregates, returning a dict keyed on (Top id, klass) of (stored, expected)
+    Annotations for each rollup that's wrong or missing.
+
+    :param using: The database to verify them in (a shard, see DjangoAnnotation.sharding), by default the routers' choice
+    '''
+    oracle = Oracle(using=using)
+    stored = {(r.top_id, r.klass): r for r in TopRollup.objects.using(using)}
+    wrong = {}
+    for key in set(stored) | {(top, klass) for top, by_klass in oracle.annotations.items() for klass in by_klass}:
+        top, klass = key
+        expected = oracle.get(top, klass) if top in oracle.annotations else None
+        got = stored.get(key)
+        if got is not None:
+            got = Annotations(got.middle_count, got.lower_count, got.high_rank_sums)
+        if got != expected:
+            wrong[key] = (got, expected)
+    return wrong
+
+
+@contextmanager
+def suspended():
+    '''
+    Suspends the signal handlers (in this thread) for the duration of the context.
+    '''
+    pending().suspended += 1
+    try:
+        yield
+    finally:
+        pending().suspended -= 1
+
+
+def flush(using=DEFAULT_DB_ALIAS):
+    dirty = pending()
+    tops, middles = dirty.tops.pop(using, set()), dirty.middles.pop(using, set())
+    if middles:
+        tops.update(Middle.objects.using(using).filter(id__in=middles).values_list('reports_to_id', flat=True))
+    refresh(tops, using)
+
+
+def mark(tops=(), middles=(), using=DEFAULT_DB_ALIAS):
+    dirty = pending()
+    dirty.tops[using].update(t for t in tops if t is not None)
+    dirty.middles[using].update(m for m in middles if m is not None)
+    # A flush with nothing dirty costs nothing, so we don't mind registering one per change
+    transaction.on_commit(lambda: flush(using), using=using)
+
+
+@receiver(pre_save, sender=Middle)
+@receiver(pre_save, sender=Lower)
+def remember_parent(sender, instance, using, **kwargs):
+    '''
+    Remembers what an existing Middle or Lower reported to before it's saved, in case it's moving.
+    '''
+    if not pending().suspended and not instance._state.adding:
+        instance._rollup_was = sender.objects.using(using).filter(pk=instance.pk).values_list('reports_to_id', flat=True).first()
+
+
+@receiver(post_save, sender=Top)
+def top_saved(sender, instance, created, using, **kwargs):
+    if created and not pending().suspended:
+        mark(tops=(instance.pk,), using=using)
+
+
+@receiver(post_save, sender=Middle)
+def middle_saved(sender, instance, using, **kwargs):
+    if not pending().suspended:
+        mark(tops=(getattr(instance, '_rollup_was', None), instance.reports_to_id), using=using)
+
+
+@receiver(post_save, sender=Lower)
+def lower_saved(sender, instance, using, **kwargs):
+    if not pending().suspended:
+        mark(middles=(getattr(instance, '_rollup_was', None), instance.reports_to_id), using=using)
+
+
+@receiver(pre_delete, sender=Lower)
+def lower_deleting(sender, instance, using, **kwargs):
+    # The Middle may be deleted along with the Lower, so we need its Top now.
+    if not pending().suspended:
+        instance._rollup_was = Middle.objects.using(using).filter(pk=instance.reports_to_id).values_list('reports_to_id', flat=True).first()
+
+
+@receiver(post_delete, sender=Middle)
+def middle_deleted(sender, instance, using, **kwargs):
+    if not pending().suspended:
+        mark(tops=(instance.reports_to_id,), using=using)
+
+
+@receiver(post_delete, sender=Lower)
+def lower_deleted(sender, instance, using, **kwargs):
+    if not pending().suspended:
+        mark(tops=(getattr(instance, '_rollup_was', None),), using=using)
@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.1/ref/settings/
 """
 
+import os
+
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -74,10 +76,44 @@ WSGI_APPLICATION = 'DjangoAnnotation.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.1/ref/settings/#databases
 
+# The SQLite performance profile applied to each new connection (see DjangoAnnotation/sqlite.py).
+#
+# performance: Write ahead logging, so readers don't block the writer, synced at checkpoints rather than every
+#              commit (a power cut can lose the last transactions, but can't corrupt the database), with 256 MiB
+#              of the file memory mapped, a 64 MiB page cache and temporary tables and indexes in memory.
+# default:     SQLite's own defaults.
+SQLITE_PROFILES = {
+    'default': {'journal_mode': 'DELETE', 'synchronous': 'FULL', 'mmap_size': 0, 'cache_size': -2000, 'temp_store': 'DEFAULT'},
+    'performance': {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'mmap_size': 256 * 2**20, 'cache_size': -64000, 'temp_store': 'MEMORY'},
+}
+SQLITE_PROFILE = os.environ.get('SQLITE_PROFILE', 'performance')
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Keep connections (and with them the page cache) open between requests, rather than one per request
+        'CONN_MAX_AGE': int(os.environ.get('CONN_MAX_AGE', 600)),
+        'CONN_HEALTH_CHECKS': True,
+    }
+}
+
+# The Tops, with their Middles, Lowers and rollups, can be sharded by Top id across this many more SQLite databases,
+# shard0.sqlite3 and on, with the Persons (the rank counters) kept in the default one (see DjangoAnnotation/sharding.py).
+# 0 (none) by default, when the whole tree is in the default database.
+SHARDS = int(os.environ.get('SHARDS', 0))
+DATABASES.update({f'shard{i}': {**DATABASES['default'], 'NAME': BASE_DIR / f'shard{i}.sqlite3'} for i in range(SHARDS)})
+DATABASE_ROUTERS = ['DjangoAnnotation.sharding.TopShardRouter'] if SHARDS else []
+
+
+# Caches the annotated Tops (see DjangoAnnotation/cache.py). Entries are keyed on the versions of the tables they
+# come from, so are never stale, and the least recently used are evicted when the cache is full.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'annotations',
+        'TIMEOUT': 3600,
+        'OPTIONS': {'MAX_ENTRIES': 1000},
     }
 }
 
@@ -0,0 +1,182 @@
+'''
+Shards the tree across several SQLite databases by Top id, and aggregates it across them.
+
+With settings.SHARDS (or the SHARDS environment variable) set to N, databases shard0 to shard{N-1} are configured
+and each Top lives, with its Middles, Lowers and rollups, in shard (Top id % N). No query ever needs more than one
+shard, as every annotation is of one Top. The Persons, the counters Lowers are ranked by (see
+DjangoAnnotation.ranks), stay in the default database so that ranks are handed out across the whole tree as
+before. Each shard holds copies of the Persons its Lowers refer to, with the same ids (and no last_rank).
+
+TopShardRouter routes an object to the shard of its Top when its Top is known (so a Top needs its id before it's
+saved) and otherwise leaves it to the object's own database or the default one. Objects saved one at a time reach
+their shard, and the rollup, denormalise and cache signal handlers follow them there. QuerySets that aren't about
+one object (QuerySet.create among them) can't be routed, and are run on a shard with .using(). load_data
+--sharded generates a tree straight into the shards, and gather() runs a strategy on every shard concurrently and
+merges the results.
+
+SQLite takes one writer at a time per database file, so each shard is written to independently, and releases the
+GIL while it runs a query, so a thread per shard overlaps their queries on as many cores as there are.
+'''
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from django.conf import settings
+from django.core.management import call_command
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from DjangoAnnotation.models import Top, Middle, Lower, Person, TopRollup
+from DjangoAnnotation.oracle import Oracle
+from DjangoAnnotation.strategies import STRATEGIES
+
+
+def aliases():
+    '''
+    The database aliases of the shards, in order.
+    '''
+    return [f'shard{i}' for i in range(settings.SHARDS)]
+
+
+def databases():
+    '''
+    The aliases of the databases the tree is in: the shards, or the default database when there are none.
+    '''
+    return aliases() or [DEFAULT_DB_ALIAS]
+
+
+def shard_for(top):
+    '''
+    The alias of the shard a Top (or Top id) lives in.
+    '''
+    top = getattr(top, 'pk', top)
+    return f'shard{top % settings.SHARDS}'
+
+
+class TopShardRouter:
+    '''
+    Routes Tops, Middles, Lowers and TopRollups (and the Persons reached from Lowers) to the shard of their Top.
+    '''
+
+    # The attribute holding the Top id of each model routed
+    TOP_ATTRIBUTES = {Top: 'id', Middle: 'reports_to_id', Lower: 'top_id', TopRollup: 'top_id'}
+
+    def route(self, model, **hints):
+        # Read from the instance's __dict__, so as never to load a deferred field (or one not yet set on an
+        # instance being made). Without a Top to go by, Django uses the database the instance came from, or the
+        # default one.
+        instance = hints.get('instance')
+        attribute = self.TOP_ATTRIBUTES.get(type(instance))
+        top = instance.__dict__.get(attribute) if attribute and settings.SHARDS else None
+        return None if top is None else shard_for(top)
+
+    db_for_read = route
+    db_for_write = route
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # The shards hold the tree alone, not the tables of Django's own apps
+        return app_label == 'DjangoAnnotation' if db in aliases() else None
+
+
+# The strategies that return a QuerySet, which can be run on a shard
+SHARDABLE = sorted(name for name, s in STRATEGIES.items() if s.queryset)
+
+
+def on_shards(function, workers=None):
+    '''
+    Runs function(alias) for each shard on a pool of threads, returning what each returned in shard order.
+
+    :param workers: The number of threads, by default one per shard
+    '''
+    def run(alias):
+        try:
+            return function(alias)
+        finally:
+            # Django opens a connection to the shard per thread, which would outlive the pool's threads unclosed
+            connections[alias].close()
+
+    with ThreadPoolExecutor(max_workers=workers or len(aliases())) as pool:
+        return list(pool.map(run, aliases()))
+
+
+def migrate():
+    '''
+    Creates (or brings up to date) the tables of every shard.
+    '''
+    for alias in aliases():
+        call_command('migrate', 'DjangoAnnotation', database=alias, verbosity=0)
+
+
+def write(tops, middles, lowers, batch_size=10000, copied=None):
+    '''
+    Writes new Tops, Middles and Lowers to the shards of their Tops, with copies of the Persons of the Lowers.
+
+    The Tops must have ids and the Lowers must be ranked (see DjangoAnnotation.ranks). The Middles and Lowers take
+    their ids from their shard.
+
+    :param copied: Optionally, a dict keyed on shard alias of the sets of ids of the Persons copied to each shard
+                   already, which aren't copied again (and are added to), for writing a tree in batches
+    '''
+    batches = {alias: ([], [], []) for alias in aliases()}
+    for T in tops:
+        batches[shard_for(T)][0].append(T)
+    for M in middles:
+        batches[shard_for(M.reports_to)][1].append(M)
+    for L in lowers:
+        batches[shard_for(L.top)][2].append(L)
+
+    for alias, (shard_tops, shard_middles, shard_lowers) in batches.items():
+        done = set() if copied is None else copied.setdefault(alias, set())
+        persons = {L.person_id: Person(id=L.person_id, name=L.name) for L in shard_lowers if L.person_id not in done}
+        done.update(persons)
+        with transaction.atomic(using=alias):
+            Person.objects.using(alias).bulk_create(persons.values(), batch_size=batch_size, ignore_conflicts=True)
+            Top.objects.using(alias).bulk_create(shard_tops, batch_size=batch_size)
+            Middle.objects.using(alias).bulk_create(shard_middles, batch_size=batch_size)
+            Lower.objects.using(alias).bulk_create(shard_lowers, batch_size=batch_size)
+
+
+def evaluate(alias, strategy, klass=None):
+    '''
+    Runs a strategy on one shard, returning a dict keyed on Top id of tuples of the fields it provides.
+    '''
+    return {t.id: tuple(getattr(t, f) for f in strategy.provides) for t in strategy.tops(klass).using(alias)}
+
+
+def gather(strategy, klass=None, workers=None):
+    '''
+    Runs a strategy on every shard concurrently, returning a dict keyed on Top id (in Top id order) of tuples of the
+    fields it provides, as strategies.evaluate does on one database. Every Top is in one shard, so the results of
+    the shards are merged by putting them together.
+
+    :param strategy: A Strategy or the name of one, which must return a QuerySet (see SHARDABLE)
+    :param klass:    The klass of Middle to restrict the annotations to (None for any klass)
+    :param workers:  The number of shards queried at once, by default all of them
+    '''
+    if isinstance(strategy, str):
+        strategy = STRATEGIES[strategy]
+    if strategy.name not in SHARDABLE:
+        raise ValueError(f"The {strategy.name} strategy can't be run on a shard, choose from {', '.join(SHARDABLE)}")
+    found = {}
+    for results in on_shards(partial(evaluate, strategy=strategy, klass=klass), workers):
+        found.update(results)
+    return dict(sorted(found.items()))
+
+
+def klasses(workers=None):
+    '''
+    The klasses of the Middles in every shard, sorted.
+    '''
+    found = on_shards(lambda alias: set(Middle.objects.using(alias).order_by().values_list('klass', flat=True).distinct()), workers)
+    return sorted(set().union(*found))
+
+
+def oracle(workers=None):
+    '''
+    An Oracle of every Top in every shard, built in each shard concurrently.
+    '''
+    merged, *others = on_shards(lambda alias: Oracle(using=alias), workers)
+    for other in others:
+        merged.names.update(other.names)
+        merged.annotations.update(other.annotations)
+        merged.klasses = sorted(set(merged.klasses) | set(other.klasses))
+    merged.names = dict(sorted(merged.names.items()))
+    return merged
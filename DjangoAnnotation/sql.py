@@ -0,0 +1,217 @@
+'''
+Tools for seeing the SQL Django runs, and how the database plans to run it.
+
+Compiling a QuerySet and pretty printing its SQL are not cheap (sqlparse takes tens of milliseconds on a large
+statement), so both are cached: the compiled SQL and params for as long as the Query they came from lives, and
+the pretty printed text of the most recently seen statements keyed on the text itself, so that identical
+QuerySets built afresh share it.
+'''
+import re
+import sqlparse
+import weakref
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+from django.db import connections
+from django.db.models.query import RawQuerySet
+
+# A step in a query plan. On SQLite, id and parent are those EXPLAIN QUERY PLAN reports (the plan is a tree).
+# Elsewhere the plan is just lines of text, and id is the line number and parent is None.
+PlanStep = namedtuple('PlanStep', ('id', 'parent', 'detail', 'flags'))
+
+# Flags we raise on plan steps that tend to explain slow queries on big tables
+FULL_SCAN = "FULL SCAN"
+TEMP_BTREE = "TEMP B-TREE"
+
+# SQLite reports "SCAN TABLE x" before 3.36 and "SCAN x" since, and scans subquery results and constant
+# rows with the same words. Only a table scanned without an index is a full scan.
+re_scan = re.compile(r'^SCAN (?:TABLE )?(?!CONSTANT ROW|SUBQUERY|\()(\S+)')
+re_temp_btree = re.compile(r'USE TEMP B-TREE FOR (.+)$')
+
+# Statements longer than this (in characters) are not pretty printed, sqlparse's time growing faster than their length
+PRETTY_MAX_LENGTH = 10000
+
+# The SQL and params each Query compiles to, keyed on the Query then the database alias. Filtering and the like
+# clone a QuerySet's Query rather than change it, so it compiles to the same SQL for as long as it lives.
+compiled = weakref.WeakKeyDictionary()
+
+
+def sql_with_params(queryset):
+    '''
+    The SQL and params a QuerySet or RawQuerySet would execute, and the alias of the database it would run on.
+
+    :param queryset: A Django QuerySet or RawQuerySet
+    '''
+    if isinstance(queryset, RawQuerySet):
+        return queryset.raw_query, tuple(queryset.params or ()), queryset.db
+    query, using = queryset.query, queryset.db
+    by_alias = compiled.setdefault(query, {})
+    if using not in by_alias:
+        by_alias[using] = query.get_compiler(using=using).as_sql()
+    sql, params = by_alias[using]
+    return sql, params, using
+
+
+def clear_caches():
+    '''
+    Empties the caches of compiled and pretty printed SQL.
+    '''
+    compiled.clear()
+    interpolate.cache_clear()
+    prettify.cache_clear()
+
+
+@lru_cache(maxsize=256)
+def interpolate(sql, params, types):
+    '''
+    The SQL with its params written in, as text that can be pasted into a query tool.
+
+    types are the types of the params, only there to key the cache: 1 and True are equal so would otherwise
+    share an entry, though they're written in differently.
+    '''
+    # DateTimes and TimeDeltas are alas converted to strings without the requiste
+    # wrapping in single quotes. So we replace them by strign reps wrapped in single
+    # quotes
+    params = list(params)
+    for i, p in enumerate(params):
+        if isinstance(p, datetime):
+            params[i] = "'" + str(p) + "'"
+        elif isinstance(p, timedelta):
+            params[i] = "INTERVAL '" + str(p) + "'"
+    params = tuple(params)
+
+    # And this is used when excuted as described here:
+    #  https://docs.djangoproject.com/en/2.2/topics/db/sql/#passing-parameters-into-raw
+    #
+    # The key note being:
+    #     params is a list or dictionary of parameters.
+    #     You’ll use %s placeholders in the query string for a list,
+    #     or %(key)s placeholders for a dictionary (where key is replaced
+    #     by a dictionary key, of course)
+    #
+    # Which is precisely how Python2 standard % formating works.
+    return sql % params
+
+
+@lru_cache(maxsize=256)
+def prettify(SQL):
+    return sqlparse.format(SQL, reindent=True, keyword_case='upper')
+
+
+def plan_flags(detail):
+    '''
+    The flags that apply to one line of an SQLite query plan.
+
+    :param detail: The detail column of an EXPLAIN QUERY PLAN row
+    '''
+    flags = []
+    if re_scan.match(detail) and 'USING' not in detail:
+        flags.append(FULL_SCAN)
+    temp = re_temp_btree.search(detail)
+    if temp:
+        flags.append(f"{TEMP_BTREE} ({temp.group(1)})")
+    return tuple(flags)
+
+
+def get_plan(queryset):
+    '''
+    Asks the database how it would run a QuerySet, returning a list of PlanSteps.
+
+    On SQLite this uses EXPLAIN QUERY PLAN and flags full table scans and temporary B-trees (which SQLite
+    builds to GROUP BY, DISTINCT or ORDER BY when no index delivers rows in the needed order). Other
+    databases are asked with their own EXPLAIN, and their plan lines are returned unflagged.
+
+    :param queryset: A Django QuerySet or RawQuerySet
+    '''
+    sql, params, using = sql_with_params(queryset)
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return [PlanStep(step, parent, detail, plan_flags(detail)) for step, parent, _, detail in cursor.fetchall()]
+        else:
+            cursor.execute(connection.ops.explain_query_prefix() + ' ' + sql, params)
+            return [PlanStep(i, None, ' '.join(str(c) for c in row), ()) for i, row in enumerate(cursor.fetchall())]
+
+
+def format_plan(plan):
+    '''
+    A query plan as indented text, one step per line, with any flags appended.
+
+    :param plan: A list of PlanSteps as returned by get_plan()
+    '''
+    depth = {}
+    lines = []
+    for step in plan:
+        depth[step.id] = depth.get(step.parent, -1) + 1
+        flags = f"    <-- {', '.join(step.flags)}" if step.flags else ""
+        lines.append(f"{'  ' * depth[step.id]}{step.detail}{flags}")
+    return '\n'.join(lines)
+
+
+def get_SQL(queryset, explain=False, pretty=True, max_pretty_length=PRETTY_MAX_LENGTH):
+    '''
+    A workaround for a bug in Django which is reported here (several times):
+        https://code.djangoproject.com/ticket/30132
+        https://code.djangoproject.com/ticket/25705
+        https://code.djangoproject.com/ticket/25092
+        https://code.djangoproject.com/ticket/24991
+        https://code.djangoproject.com/ticket/17741
+
+    that should be documented here:
+        https://docs.djangoproject.com/en/2.1/faq/models/#how-can-i-see-the-raw-sql-queries-django-is-running
+    but isn't.
+
+    The work around was published by Zach Borboa here:
+        https://code.djangoproject.com/ticket/17741#comment:4
+
+    :param queryset: A Django QuerySet or RawQuerySet
+    :param explain:  If True uses the server's EXPLAIN function. Not good for invalid SQL alas.
+                     Returns a tuple of the SQL and the query plan (a list of PlanSteps, see get_plan) in this case.
+    :param pretty:   Format the SQL nicely
+    :param max_pretty_length: Don't format SQL longer than this (None to format SQL of any length)
+    '''
+    if explain:
+        sql, params, using = sql_with_params(queryset)
+        plan = get_plan(queryset)
+        cursor = connections[using].cursor()
+        SQL = cursor.db.ops.last_executed_query(cursor, sql, params)
+    else:
+        # We don't want to execute a query in this case but find the SQL reliably from Django
+
+        # We can get SQL and params from the query compiler
+        sql, params, using = sql_with_params(queryset)
+        params = tuple(params)
+        types = tuple(type(p) for p in params)
+        try:
+            SQL = interpolate(sql, params, types)
+        except TypeError:
+            # A param that can't be hashed (a list say) can't be cached
+            SQL = interpolate.__wrapped__(sql, params, types)
+
+    if pretty and (max_pretty_length is None or len(SQL) <= max_pretty_length):
+        SQL = prettify(SQL)
+
+    return (SQL, plan) if explain else SQL
+
+
+def print_SQL(queryset, explain=False, pretty=True, max_pretty_length=PRETTY_MAX_LENGTH):
+    '''
+    A trivial wrapper around get_SQL that simply prints the result. Useful primarily in a debugger say, to
+    produce a SQL string that can be copied and pasted into a Query Tool. That is, it doesn't have quotes
+    around it for example.
+
+    :param queryset: A Django QuerySet or RawQuerySet
+    :param explain:  If True uses the server's EXPLAIN function, and prints the query plan after the SQL.
+    :param pretty:   Format the SQL nicely
+    :param max_pretty_length: Don't format SQL longer than this (None to format SQL of any length)
+    '''
+    if explain:
+        SQL, plan = get_SQL(queryset, explain, pretty, max_pretty_length)
+        print(SQL)
+        print("\nQuery plan:")
+        print(format_plan(plan))
+    else:
+        print(get_SQL(queryset, explain, pretty, max_pretty_length))
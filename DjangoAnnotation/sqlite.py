@@ -0,0 +1,52 @@
+'''
+Applies the SQLite performance profile chosen in settings to every new connection.
+
+Django opens SQLite databases with SQLite's defaults: a rollback journal synced in full on every commit, a 2 MiB
+page cache, no memory mapping and temporary tables on disk. The profiles in settings.SQLITE_PROFILES are sets of
+PRAGMAs run when each connection is created, settings.SQLITE_PROFILE (or the SQLITE_PROFILE environment variable)
+picking one. The default profile states SQLite's defaults explicitly, because the journal mode is stored in the
+database file: a database once opened in WAL mode stays in WAL mode until something switches it back.
+'''
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+# The profile in force when not the one in settings, see activate()
+active = None
+
+
+def profile():
+    '''
+    The name of the profile in force.
+    '''
+    return active or settings.SQLITE_PROFILE
+
+
+def pragmas(name=None):
+    '''
+    The PRAGMA statements of a profile (by default the one in force).
+    '''
+    name = name or profile()
+    if name not in settings.SQLITE_PROFILES:
+        raise ValueError(f"Unknown SQLite profile '{name}', choose from {', '.join(settings.SQLITE_PROFILES)}")
+    return [f"PRAGMA {pragma} = {value}" for pragma, value in settings.SQLITE_PROFILES[name].items()]
+
+
+def activate(name=None):
+    '''
+    Puts a profile in force in place of the one in settings (or restores the one in settings), closing the
+    open connections so that it's applied to the next ones.
+    '''
+    global active
+    pragmas(name)
+    active = name
+    connections.close_all()
+
+
+@receiver(connection_created)
+def apply_profile(sender, connection, **kwargs):
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            for pragma in pragmas():
+                cursor.execute(pragma)
@@ -0,0 +1,269 @@
+'''
+The annotation strategies that produce correct results, gathered so they can be run and compared by name.
+
+Each strategy is a function taking an optional klass and returning an iterable of Tops annotated with the
+fields it provides (some or all of middle_count, lower_count and high_rank_sums). The exploratory attempts
+that fail live on in the annotate command's test_query.
+
+A strategy that runs more than one query has an explain function, taking the same klass, that returns a
+representative QuerySet to inspect the query plan of. A strategy marked queryset returns a QuerySet, which can be
+ordered, filtered, sliced and run on another database, without having to call it to find out.
+'''
+from collections import namedtuple
+from functools import partial
+from importlib.util import find_spec
+
+from django.db.models import Count, F, FilteredRelation, Max, Q, QuerySet, Sum, Value
+from django.db.models.functions import Coalesce
+
+from DjangoAnnotation.expressions import SubqueryCount, SumOfMax
+from DjangoAnnotation.models import Top, Middle, Lower
+from DjangoAnnotation.vectorised import VectorOracle, lowers
+
+COUNTS = ('middle_count', 'lower_count')
+SUMS = ('high_rank_sums',)
+
+Strategy = namedtuple('Strategy', ('name', 'provides', 'tops', 'explain', 'queryset'), defaults=(None, False))
+
+
+def count_distinct(klass=None):
+    '''
+    The obvious annotation: Count over the joined Middles and Lowers, de-duplicated with distinct.
+    '''
+    mfilter = None if klass is None else Q(middles__klass=klass)
+    return Top.objects.annotate(
+        middle_count=Count('middles', distinct=True, filter=mfilter),
+        lower_count=Count('middles__lowers', distinct=True, filter=mfilter),
+    )
+
+
+def count_subquery(klass=None):
+    '''
+    The counts with SubqueryCount, each in its own correlated subquery joining only what it counts.
+    '''
+    mfilter = None if klass is None else Q(middles__klass=klass)
+    return Top.objects.annotate(
+        middle_count=SubqueryCount('middles', filter=mfilter),
+        lower_count=SubqueryCount('middles__lowers', filter=mfilter),
+    )
+
+
+def sum_of_max_raw(klass=None, denormalised=False, key='name'):
+    '''
+    The sum of the highest rank of each Lower name under a Top, in raw SQL (Django can't express it).
+
+    Tops with no Lowers (of the klass) are not returned at all.
+
+    :param denormalised: Group the Lowers on their copies of their Middle's Top and klass, without joining Middle
+    :param key:          The Lower field to group the ranks by, 'name' or 'person' (the name interned as an int)
+    '''
+    key = Lower._meta.get_field(key).column
+    if denormalised:
+        where_klass = "" if klass is None else 'WHERE L."klass" = %s\n'
+        query = f"""
+            SELECT id, name, SUM(max) AS high_rank_sums
+            FROM
+                (SELECT T."id" AS id, T."name" AS name, MAX(L."rank") AS max
+                 FROM "{Top._meta.db_table}" T
+                 INNER JOIN "{Lower._meta.db_table}" L ON L.top_id = T.id
+                 {where_klass}GROUP BY T."id",T."name", L."{key}")
+            GROUP BY id, name
+        """
+        return Top.objects.raw(query, [] if klass is None else [klass])
+
+    where_klass = "" if klass is None else 'WHERE M."klass" = %s\n'
+    query = f"""
+        SELECT id, name, SUM(max) AS high_rank_sums
+        FROM
+            (SELECT T."id" AS id, T."name" AS name, MAX(L."rank") AS max
+             FROM "{Top._meta.db_table}" T
+             INNER JOIN "{Middle._meta.db_table}" M ON M.reports_to_id = T.id
+             INNER JOIN "{Lower._meta.db_table}" L ON L.reports_to_id = M.id
+             {where_klass}GROUP BY T."id",T."name", L."{key}")
+        GROUP BY id, name
+    """
+    return Top.objects.raw(query, [] if klass is None else [klass])
+
+
+def sum_of_max_expression(klass=None):
+    '''
+    The sum of the highest rank of each Lower name under a Top, with the SumOfMax expression (a correlated subquery).
+    '''
+    mfilter = None if klass is None else Q(middles__klass=klass)
+    return Top.objects.annotate(high_rank_sums=SumOfMax('middles__lowers__rank', group_by='middles__lowers__name', filter=mfilter))
+
+
+def subqueries(klass=None, key='name'):
+    '''
+    All the annotations, each in its own correlated subquery (SubqueryCount and SumOfMax), in one query.
+
+    :param key: The Lower field to group the ranks by, 'name' or 'person' (the name interned as an int)
+    '''
+    mfilter = None if klass is None else Q(middles__klass=klass)
+    return Top.objects.annotate(
+        middle_count=SubqueryCount('middles', filter=mfilter),
+        lower_count=SubqueryCount('middles__lowers', filter=mfilter),
+        high_rank_sums=SumOfMax('middles__lowers__rank', group_by=f'middles__lowers__{key}', filter=mfilter),
+    )
+
+
+def denormalised_subqueries(klass=None, key='name'):
+    '''
+    All the annotations, as subqueries does, with the Lower counts and sums read from the Lowers of each Top by
+    their copies of their Middle's Top and klass (Top.lowers), without joining Middle.
+
+    :param key: The Lower field to group the ranks by, 'name' or 'person' (the name interned as an int)
+    '''
+    mfilter = None if klass is None else Q(middles__klass=klass)
+    lfilter = None if klass is None else Q(lowers__klass=klass)
+    return Top.objects.annotate(
+        middle_count=SubqueryCount('middles', filter=mfilter),
+        lower_count=SubqueryCount('lowers', filter=lfilter),
+        high_rank_sums=SumOfMax('lowers__rank', group_by=f'lowers__{key}', filter=lfilter),
+    )
+
+
+def highest_ranks(top, klass=None, denormalised=False):
+    '''
+    The highest rank of each Lower name under one Top.
+
+    :param denormalised: Find the Lowers by their copies of their Middle's Top and klass, without joining Middle
+    '''
+    if denormalised:
+        l_filter = Q(top=top) if klass is None else Q(top=top, klass=klass)
+        return Lower.objects.filter(l_filter).values('top', 'name').annotate(highest_rank=Max('rank')).values('highest_rank')
+    l_filter = Q(reports_to__reports_to=top)
+    if not klass is None:
+        l_filter &= Q(reports_to__klass=klass)
+    return Lower.objects.filter(l_filter).values('reports_to__reports_to', 'name').annotate(highest_rank=Max('rank')).values('highest_rank')
+
+
+def sum_of_max_per_top(klass=None):
+    '''
+    The sum of the highest rank of each Lower name, with a grouped Max then Sum query for each Top.
+    '''
+    for top in Top.objects.all():
+        top.high_rank_sums = highest_ranks(top, klass).aggregate(total=Sum('highest_rank'))['total']
+        yield top
+
+
+def from_rollup(klass=None):
+    '''
+    All the annotations, read from the TopRollup maintained by DjangoAnnotation.rollup with a join to one row per Top.
+    '''
+    condition = Q(rollups__klass__isnull=True) if klass is None else Q(rollups__klass=klass)
+    return Top.objects.annotate(
+        rollup=FilteredRelation('rollups', condition=condition),
+        middle_count=Coalesce(F('rollup__middle_count'), Value(0)),
+        lower_count=Coalesce(F('rollup__lower_count'), Value(0)),
+        high_rank_sums=F('rollup__high_rank_sums'),
+    )
+
+
+def cached_sum_of_max(klass=None):
+    '''
+    The sum_of_max_expression annotations, served from the cache until Tops, Middles or Lowers change.
+    '''
+    # Imported here as DjangoAnnotation.cache builds on this module
+    from DjangoAnnotation.cache import annotated_tops
+    return annotated_tops('sum_of_max_expression', klass)
+
+
+def vectorised(klass=None):
+    '''
+    All the annotations, computed in NumPy from the columns of the whole tree (see DjangoAnnotation.vectorised).
+    '''
+    oracle = VectorOracle()
+    for top, name in oracle.names.items():
+        T = Top(id=top, name=name)
+        T.middle_count, T.lower_count, T.high_rank_sums = oracle.get(top, klass)
+        yield T
+
+
+STRATEGIES = {s.name: s for s in (
+    Strategy('count_distinct', COUNTS, count_distinct, queryset=True),
+    Strategy('count_subquery', COUNTS, count_subquery, queryset=True),
+    Strategy('sum_of_max_raw', SUMS, sum_of_max_raw),
+    Strategy('sum_of_max_expression', SUMS, sum_of_max_expression, queryset=True),
+    Strategy('sum_of_max_per_top', SUMS, sum_of_max_per_top, lambda klass: highest_ranks(Top.objects.first(), klass)),
+    Strategy('subqueries', COUNTS + SUMS, subqueries, queryset=True),
+    Strategy('sum_of_max_raw_denormalised', SUMS, partial(sum_of_max_raw, denormalised=True)),
+    Strategy('denormalised_subqueries', COUNTS + SUMS, denormalised_subqueries, queryset=True),
+    Strategy('sum_of_max_raw_by_person', SUMS, partial(sum_of_max_raw, key='person')),
+    Strategy('subqueries_by_person', COUNTS + SUMS, partial(subqueries, key='person'), queryset=True),
+    Strategy('denormalised_subqueries_by_person', COUNTS + SUMS, partial(denormalised_subqueries, key='person'), queryset=True),
+    Strategy('rollup', COUNTS + SUMS, from_rollup, queryset=True),
+    Strategy('cached_sum_of_max', SUMS, cached_sum_of_max, sum_of_max_expression),
+)}
+
+# NumPy is optional
+if find_spec('numpy'):
+    STRATEGIES['vectorised'] = Strategy('vectorised', COUNTS + SUMS, vectorised, lambda klass: lowers())
+
+
+def explain(strategy, klass=None):
+    '''
+    The QuerySet (or RawQuerySet) to inspect the query plan of, for a strategy.
+
+    :param strategy: A Strategy or the name of one
+    :param klass:    The klass of Middle to restrict the annotations to (None for any klass)
+    '''
+    if isinstance(strategy, str):
+        strategy = STRATEGIES[strategy]
+    return strategy.explain(klass) if strategy.explain else strategy.tops(klass)
+
+
+def select(strategy, klass=None, top=None):
+    '''
+    Runs a strategy, returning its annotated Tops, or just one of them.
+
+    :param strategy: A Strategy or the name of one
+    :param klass:    The klass of Middle to restrict the annotations to (None for any klass)
+    :param top:      Optionally a Top or Top id to annotate alone
+    '''
+    if isinstance(strategy, str):
+        strategy = STRATEGIES[strategy]
+    tops = strategy.tops(klass)
+    if top is None:
+        return tops
+    top = getattr(top, 'pk', top)
+    if isinstance(tops, QuerySet):
+        return tops.filter(pk=top)
+    # Raw SQL and generators can only be filtered as they're read
+    return [t for t in tops if t.pk == top]
+
+
+def evaluate(strategy, klass=None, top=None):
+    '''
+    Runs a strategy, returning a dict keyed on Top id of tuples of the fields it provides.
+
+    :param strategy: A Strategy or the name of one
+    :param klass:    The klass of Middle to restrict the annotations to (None for any klass)
+    :param top:      Optionally a Top or Top id to annotate alone
+    '''
+    if isinstance(strategy, str):
+        strategy = STRATEGIES[strategy]
+    return {t.id: tuple(getattr(t, f) for f in strategy.provides) for t in select(strategy, klass, top)}
+
+
+def mismatches(strategy, results, oracle, klass=None):
+    '''
+    Compares the results of evaluate() with an Oracle, returning a dict keyed on Top id of (got, expected)
+    for each Top that's wrong. A Top missing from the results is taken as having all fields None.
+
+    :param strategy: A Strategy or the name of one
+    :param results:  The results of evaluate(strategy, klass)
+    :param oracle:   An Oracle
+    :param klass:    The klass results were evaluated for
+    '''
+    if isinstance(strategy, str):
+        strategy = STRATEGIES[strategy]
+    wrong = {}
+    missing = (None,) * len(strategy.provides)
+    for top in oracle.names:
+        expected = oracle.get(top, klass)
+        expected = tuple(getattr(expected, f) for f in strategy.provides)
+        got = results.get(top, missing)
+        if got != expected:
+            wrong[top] = (got, expected)
+    return wrong
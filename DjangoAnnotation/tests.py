@@ -0,0 +1,166 @@
+'''
+Tests of the expressions and performance regression tests, run on the test database with manage.py test.
+
+On seeded trees of a few sizes, load_data, list_data and every annotation strategy are held with assertNumQueries
+to the query counts recorded in perf_baselines.json for the size, and each strategy's results are checked against
+the Oracle.
+
+The times recorded there were measured on one machine, so they're only checked when asked for, with
+PERF_BUDGETS=check: the fastest of a few runs may take PERF_TOLERANCE (default 1.5) times its baseline plus
+PERF_SLACK seconds (default 0.02, so the shortest checks aren't failed by timer noise). PERF_BUDGETS=update records
+the query counts and times measured as the new baselines instead, to do after changing the queries on purpose or
+to get budgets for a machine of your own.
+
+    python manage.py test DjangoAnnotation
+    PERF_BUDGETS=check python manage.py test DjangoAnnotation
+'''
+import io
+import json
+import os
+
+from contextlib import redirect_stdout
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Count, Q
+from django.test import TestCase
+
+from DjangoAnnotation.expressions import SubqueryCount
+from DjangoAnnotation.models import Top, Middle, Lower
+from DjangoAnnotation.oracle import Oracle
+from DjangoAnnotation.profiling import measure
+from DjangoAnnotation.strategies import STRATEGIES, evaluate, mismatches
+
+# Where the baselines are kept, committed with the code they hold it to
+BASELINES = settings.BASE_DIR / 'perf_baselines.json'
+
+# None to check the query counts alone, 'check' to check the times too, or 'update' to record new baselines
+BUDGETS = os.environ.get('PERF_BUDGETS')
+TOLERANCE = float(os.environ.get('PERF_TOLERANCE', 1.5))
+SLACK = float(os.environ.get('PERF_SLACK', 0.02))
+
+
+def load_baselines():
+    try:
+        with open(BASELINES) as baselines_file:
+            return json.load(baselines_file)
+    except FileNotFoundError:
+        return {}
+
+
+class PerformanceTests:
+    '''
+    The checks, run on a tree of TOPS Tops by each of the TestCases below.
+    '''
+    # The tree the checks are run on
+    TOPS = None
+    SEED = 1
+    # The number of timed runs of each check, the fastest counting
+    REPEAT = 3
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.baselines = load_baselines()
+        cls.measured = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        if BUDGETS == 'update' and cls.measured:
+            # Read again, as the TestCase of another size may have recorded its own since
+            baselines = load_baselines()
+            with open(BASELINES, 'w') as baselines_file:
+                json.dump(dict(sorted({**baselines, **cls.measured}.items())), baselines_file, indent=2)
+                baselines_file.write('\n')
+        super().tearDownClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('load_data', tops=cls.TOPS, seed=cls.SEED, verbosity=0)
+        cls.oracle = Oracle()
+
+    def setUp(self):
+        # The cache outlives the rolled back test data, whose table versions the cache keys would repeat
+        cache.clear()
+
+    def check(self, check, repeat, function, *args, **kwargs):
+        '''
+        Runs a check, asserting that it runs the number of queries in its baseline and, if the budgets are checked,
+        that the fastest of repeat runs takes no longer than the baseline allows. Returns what the check returned.
+        '''
+        baseline = self.baselines.get(check)
+        if BUDGETS == 'update':
+            counted = measure(function, *args, using=[connection.alias], **kwargs)
+        elif baseline is None:
+            self.fail(f"{check} has no baseline in {BASELINES.name}, record one with PERF_BUDGETS=update")
+        else:
+            with self.assertNumQueries(baseline['queries']):
+                counted = measure(function, *args, using=[connection.alias], **kwargs)
+
+        if BUDGETS is None:
+            return counted.returned
+        seconds = min([counted.seconds] + [measure(function, *args, **kwargs).seconds for _ in range(repeat - 1)])
+
+        if BUDGETS == 'update':
+            self.measured[check] = {'queries': counted.queries, 'seconds': round(seconds, 4)}
+        elif BUDGETS == 'check':
+            allowed = baseline['seconds'] * TOLERANCE + SLACK
+            self.assertLessEqual(seconds, allowed, f"{check} took {seconds:.3f}s, over its budget of {allowed:.3f}s")
+        return counted.returned
+
+    def test_load_data(self):
+        self.check(f'{self.TOPS}:load_data', self.REPEAT, call_command, 'load_data', tops=self.TOPS, seed=self.SEED, verbosity=0)
+        self.assertEqual(Top.objects.count(), self.TOPS)
+
+    def test_list_data(self):
+        def list_data():
+            with redirect_stdout(io.StringIO()) as out:
+                call_command('list_data', format='jsonl')
+            return out.getvalue()
+        rows = self.check(f'{self.TOPS}:list_data', self.REPEAT, list_data)
+        self.assertTrue(rows)
+
+    def test_strategies(self):
+        for name in sorted(STRATEGIES):
+            for klass in (None, 2):
+                with self.subTest(strategy=name, klass=klass):
+                    # So that a cached strategy is counted from cold
+                    cache.clear()
+                    results = self.check(f'{self.TOPS}:{name}:klass={klass}', self.REPEAT, evaluate, name, klass)
+                    self.assertEqual(mismatches(name, results, self.oracle, klass), {})
+
+
+class SmallTreeTests(PerformanceTests, TestCase):
+    TOPS = 100
+
+
+class LargeTreeTests(PerformanceTests, TestCase):
+    TOPS = 1000
+
+
+class SubqueryCountTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.top = Top.objects.create(name='Top')
+        for m, ranks in enumerate(([1, 2, 3], [2, 2], [1])):
+            middle = Middle.objects.create(name=f'Middle {m}', klass=1 + m % 2, reports_to=cls.top)
+            for rank in ranks:
+                Lower.objects.create(name=f'Lower {m}', rank=rank, reports_to=middle)
+
+    def counted(self, expression):
+        return Top.objects.annotate(count=expression).get(pk=self.top.pk).count
+
+    def test_counts(self):
+        self.assertEqual(self.counted(SubqueryCount('middles')), 3)
+        self.assertEqual(self.counted(SubqueryCount('middles__lowers')), 6)
+        self.assertEqual(self.counted(SubqueryCount('middles__lowers', filter=Q(middles__klass=2))), 2)
+        self.assertEqual(self.counted(SubqueryCount('middles', filter=Q(middles__klass=3))), 0)
+
+    def test_filter_past_the_path_counted(self):
+        # The filter joins the Lowers of each Middle counted, which mustn't count the Middle once per Lower
+        rank_over_1 = Q(middles__lowers__rank__gt=1)
+        expected = self.counted(Count('middles', distinct=True, filter=rank_over_1))
+        self.assertEqual(expected, 2)
+        self.assertEqual(self.counted(SubqueryCount('middles', filter=rank_over_1)), expected)
@@ -16,6 +16,11 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path
 
+from DjangoAnnotation import views
+
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('annotations/', views.annotations, name='annotations'),
+    path('annotations/<int:top>/', views.top_annotations, name='top_annotations'),
+    path('api/rollups/', views.rollups, name='rollups'),
 ]
@@ -0,0 +1,156 @@
+'''
+Views serving the annotations as JSON.
+'''
+import json
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import Http404, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import condition, require_safe
+
+from DjangoAnnotation import asynchronous, cache
+from DjangoAnnotation.models import Top
+from DjangoAnnotation.strategies import COUNTS, SUMS, STRATEGIES
+
+# The most Tops returned in one response
+MAX_LIMIT = 1000
+
+
+def int_param(request, name, default=None):
+    value = request.GET.get(name)
+    if value in (None, ''):
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an integer, got {value!r}")
+
+
+async def annotations(request):
+    '''
+    The annotations of each Top in id order, a page at a time: ?klass=&after=&limit=
+
+    The response includes the id to pass as after to get the next page (null on the last page).
+    '''
+    try:
+        klass = int_param(request, 'klass')
+        after = int_param(request, 'after')
+        limit = int_param(request, 'limit', 100)
+    except ValueError as E:
+        return HttpResponseBadRequest(str(E))
+    if not 0 < limit <= MAX_LIMIT:
+        return HttpResponseBadRequest(f"limit must be between 1 and {MAX_LIMIT}")
+
+    # One more than the page, which is there only if there's a next page
+    tops = await asynchronous.annotated_tops(klass, after, limit + 1)
+    more = len(tops) > limit
+    tops = tops[:limit]
+    return JsonResponse({
+        'klass': klass,
+        'tops': [{'id': t.id, 'name': t.name, 'middle_count': t.middle_count, 'lower_count': t.lower_count,
+                  'high_rank_sums': t.high_rank_sums} for t in tops],
+        'next': tops[-1].id if more else None,
+    })
+
+
+async def top_annotations(request, top):
+    '''
+    The annotations of one Top: ?klass=
+    '''
+    try:
+        klass = int_param(request, 'klass')
+    except ValueError as E:
+        return HttpResponseBadRequest(str(E))
+    name = await Top.objects.filter(id=top).values_list('name', flat=True).afirst()
+    if name is None:
+        raise Http404(f"No Top with id {top}")
+
+    annotations = await asynchronous.top_annotations(top, klass)
+    return JsonResponse(dict(id=top, name=name, klass=klass, **annotations._asdict()))
+
+
+# The strategies that provide all the annotations as a QuerySet (to order, filter and slice), which rollups can be served by
+ROLLUP_STRATEGIES = sorted(name for name, s in STRATEGIES.items() if set(s.provides) == set(COUNTS + SUMS) and s.queryset)
+
+# The number of Tops written to each chunk of a streamed response
+STREAM_CHUNK = 500
+
+
+async def aiterate(iterator):
+    '''
+    Iterates asynchronously over a synchronous iterator, taking each step in the thread the ORM runs in under ASGI
+    (as QuerySet.aiterator() does), so that its items are passed on as they're made.
+    '''
+    done = object()
+    while (item := await sync_to_async(next)(iterator, done)) is not done:
+        yield item
+
+
+def rollups_etag(request):
+    # The annotations change only when the tables they're read from do
+    return '.'.join(str(v) for v in cache.versions())
+
+
+def rollups_last_modified(request):
+    return cache.last_modified()
+
+
+@require_safe
+@condition(etag_func=rollups_etag, last_modified_func=rollups_last_modified)
+def rollups(request):
+    '''
+    The annotations of each Top in id order, streamed as JSON: ?klass=&after=&limit=&strategy=
+
+    With no limit every Top (after after) is returned. The response ends with the id to pass as after to get the
+    next page (null on the last page). An ETag and Last-Modified come from the versions of the tables the
+    annotations are read from (see DjangoAnnotation.cache), so a conditional GET is answered with a 304 until the
+    data changes, without running the annotation query. It streams under WSGI and ASGI alike: Django reads a
+    synchronous iterator to the end before sending any of it under ASGI, so there the chunks are handed over by an
+    asynchronous one.
+    '''
+    try:
+        klass = int_param(request, 'klass')
+        after = int_param(request, 'after')
+        limit = int_param(request, 'limit')
+    except ValueError as E:
+        return HttpResponseBadRequest(str(E))
+    if limit is not None and limit < 1:
+        return HttpResponseBadRequest("limit must be at least 1")
+    strategy = request.GET.get('strategy', 'rollup')
+    if strategy not in ROLLUP_STRATEGIES:
+        return HttpResponseBadRequest(f"strategy must be one of {', '.join(ROLLUP_STRATEGIES)}")
+
+    tops = STRATEGIES[strategy].tops(klass).order_by('id')
+    if after is not None:
+        tops = tops.filter(id__gt=after)
+    if limit is not None:
+        # One more than the page, which is there only if there's a next page
+        tops = tops[:limit + 1]
+    rows = tops.values_list('id', 'name', *COUNTS, *SUMS)
+
+    def stream():
+        # A chunk of Tops at a time, so that neither the rows nor the response are held in memory
+        encoder = DjangoJSONEncoder()
+        yield f'{{"klass": {json.dumps(klass)}, "tops": [\n'
+        # The Tops sent so far, the id of the last of them, and whether there are more after the page
+        sent = last = 0
+        more = False
+        chunk = []
+        for top, name, middle_count, lower_count, high_rank_sums in rows.iterator(chunk_size=2000):
+            if limit is not None and sent + len(chunk) == limit:
+                more = True
+                break
+            last = top
+            chunk.append(encoder.encode({'id': top, 'name': name, 'middle_count': middle_count,
+                                         'lower_count': lower_count, 'high_rank_sums': high_rank_sums}))
+            if len(chunk) == STREAM_CHUNK:
+                yield ('' if sent == 0 else ',\n') + ',\n'.join(chunk)
+                sent += len(chunk)
+                chunk = []
+        if chunk:
+            yield ('' if sent == 0 else ',\n') + ',\n'.join(chunk)
+        yield f'\n], "next": {json.dumps(last if more else None)}}}\n'
+
+    chunks = aiterate(stream()) if isinstance(request, ASGIRequest) else stream()
+    return StreamingHttpResponse(chunks, content_type='application/json')